@@ -2,10 +2,13 @@
 Data classes for describing models in a structured way
 """
 
-from dataclasses import dataclass, field
+import inspect
+import os
+from collections import OrderedDict
+from dataclasses import MISSING, dataclass, field, fields
 from functools import cached_property
 from importlib import import_module
-from typing import Optional
+from typing import Callable, Optional, Union
 
 import dill
 import jax
@@ -17,20 +20,50 @@ from typing_extensions import Self
 
 from . import core
 from . import utils as wu
-from .structure import STRUCT_N_PAR
+from .structure import PROJECTED_FUNCS, STRUCT_FUNCS, STRUCT_N_PAR, STRUCT_STAGE
+
+
+class _Stored:
+    """
+    Descriptor for a Parameter value that lives in a small numpy array.
+    Model points that array at a row of its parameter table,
+    which makes the Parameter a view into the table.
+    """
+
+    def __init__(self, col: int, default: Optional[float] = None):
+        self.col = col
+        self.default = default
+
+    def __get__(self, obj, objtype=None) -> float:
+        if obj is None:
+            # dataclass uses this to get the default
+            if self.default is None:
+                raise AttributeError("No default value")
+            return self.default
+        return float(obj._data[self.col])
+
+    def __set__(self, obj, value):
+        if "_data" not in obj.__dict__:
+            obj._data = np.zeros(2)
+        obj._data[self.col] = value
 
 
 @dataclass
 class Parameter:
     name: str
     fit: list[bool]
-    val: float
-    err: float = 0
+    val: float = _Stored(0)  # type: ignore
+    err: float = _Stored(1, 0.0)  # type: ignore
     prior: Optional[tuple[float, float]] = None  # Only flat for now
 
-    def __post_init__(self):
-        # If this isn't a float autograd breaks
-        self.val = float(self.val)
+    def __setstate__(self, state):
+        # Older pickles keep the value and error in the instance dict
+        val = state.pop("val", None)
+        err = state.pop("err", 0.0)
+        self.__dict__.update(state)
+        if val is not None:
+            self.val = val
+            self.err = err
 
     @property
     def fit_ever(self) -> bool:
@@ -54,18 +87,55 @@ class Structure:
                 f"{self.name} has incorrect number of parameters, expected {STRUCT_N_PAR[self.structure]} for {self.structure} but was given {len(self.parameters)}"
             )
 
+    @property
+    def spherical(self) -> bool:
+        """
+        Check if this is a spherically symmetric stage 0 structure.
+        Structures with radii are only considered spherical if the radii
+        are all equal and never fit.
+        """
+        if STRUCT_STAGE[self.structure] != 0:
+            return False
+        par_names = list(inspect.signature(STRUCT_FUNCS[self.structure]).parameters)
+        radii = [
+            self.parameters[par_names.index(r)]
+            for r in ("r_1", "r_2", "r_3")
+            if r in par_names
+        ]
+        if any(r.fit_ever for r in radii):
+            return False
+        return len(set(r.val for r in radii)) <= 1
+
 
 @dataclass
 class Model:
     name: str
     structures: list[Structure]
     xyz: tuple[jax.Array, jax.Array, jax.Array, float, float]  # arcseconds
-    dz: float  # arcseconds * unknown
+    dz: Union[float, jax.Array]  # arcseconds * unknown, or per sample weights
     beam: jax.Array
     n_rounds: int
     cur_round: int = 0
     chisq: float = np.inf
+    abel: bool = True
+    n_zchunk: int = 0
+    cull: float = 0.0
+    linear_conv: bool = False
+    tod_stage2: bool = False
+    tables: bool = False
+    unit_conversion: float = 1.0
+    cache_dir: Optional[str] = None
+    interp_order: int = 1
+    cache_size: int = 4
+    nested: list["Model"] = field(default_factory=list)
     original_order: list[int] = field(init=False)
+    _compiled: dict = field(init=False, repr=False, default_factory=dict)
+    _stencils: dict = field(init=False, repr=False, default_factory=dict)
+    _evals: OrderedDict = field(init=False, repr=False, default_factory=OrderedDict)
+    _stages: dict = field(init=False, repr=False, default_factory=dict)
+    _par_table: NDArray[np.floating] = field(init=False, repr=False, compare=False)
+    _fit_table: NDArray[np.bool_] = field(init=False, repr=False, compare=False)
+    _prior_table: NDArray[np.floating] = field(init=False, repr=False, compare=False)
 
     def __post_init__(self):
         # Make sure the structure is in the order that core expects
@@ -74,11 +144,56 @@ class Model:
         )
         self.structures = [self.structures[i] for i in structure_idx]
         self.original_order = list(np.sort(structure_idx))
-
-    def __set_attr__(self, name, value):
-        if name == "cur_round":
-            self.__dict__.pop("model_grad", None)
-        return super().__setattr__(name, value)
+        self._bind_parameters()
+
+        # Compile up front so the first fit iteration doesn't pay for it
+        self.compiled()
+        if np.any(self.to_fit_ever):
+            self.compiled(self.argnums)
+
+    def __getstate__(self):
+        # Compiled executables can't be serialized, they will be rebuilt when needed
+        state = self.__dict__.copy()
+        state["_compiled"] = {}
+        state["_stencils"] = {}
+        state["_evals"] = OrderedDict()
+        state["_stages"] = {}
+        return state
+
+    def __setstate__(self, state):
+        # Older pickles are missing the fields that were added since they were saved
+        for fld in fields(self):
+            if fld.name not in state and fld.default_factory is not MISSING:
+                state[fld.name] = fld.default_factory()
+        # Pickling copies the parameter views so they need to be bound again
+        self.__dict__.update(state)
+        self._bind_parameters()
+
+    def _bind_parameters(self):
+        """
+        Gather the parameters into contiguous tables in the order of self.pars.
+        The values and errors of each Parameter become views into the table,
+        the fit masks and priors are copied since they are fixed once the model is built.
+        Nested models share the tables.
+        """
+        parameters = [
+            par for structure in self.structures for par in structure.parameters
+        ]
+        self._par_table = np.array([[par.val, par.err] for par in parameters])
+        for i, par in enumerate(parameters):
+            par._data = self._par_table[i]
+        self._fit_table = np.array([par.fit for par in parameters], dtype=bool)
+        self._prior_table = np.array(
+            [
+                (-np.inf, np.inf) if par.prior is None else par.prior
+                for par in parameters
+            ],
+            dtype=float,
+        )
+        for nest in self.nested:
+            nest._par_table = self._par_table
+            nest._fit_table = self._fit_table
+            nest._prior_table = self._prior_table
 
     @cached_property
     def n_struct(self) -> list[int]:
@@ -88,12 +203,324 @@ class Model:
             n_struct[idx] += 1
         return n_struct
 
-    @property
-    def pars(self) -> list[float]:
-        pars = []
+    @cached_property
+    def beam_ft(self) -> jax.Array:
+        """
+        The transform of the beam padded to the model grid.
+        Computing this once saves an FFT on every model evaluation.
+        If linear_conv is True the padding is large enough that
+        the beam convolution does not wrap around the edge of the grid.
+        """
+        return wu.kernel_fft(
+            self.beam,
+            (self.xyz[0].shape[0], self.xyz[1].shape[1]),
+            self.linear_conv,
+        )
+
+    @cached_property
+    def cosmo(self) -> tuple[Optional[jax.Array], ...]:
+        """
+        Precomputed n(z), h(z), and da(z) for each structure type, see core.model.
+        This is only done for structures that use cosmology and whose redshift is never fit,
+        otherwise the entry is None and the structure computes them itself.
+        """
+        cosmo = []
+        for struct in core.ORDER:
+            structures = [s for s in self.structures if s.structure == struct]
+            par_names = list(inspect.signature(STRUCT_FUNCS[struct]).parameters)
+            if (
+                len(structures) == 0
+                or "cosmo" not in par_names
+                or any(s.parameters[par_names.index("z")].fit_ever for s in structures)
+            ):
+                cosmo.append(None)
+                continue
+            z = jnp.array([s.parameters[par_names.index("z")].val for s in structures])
+            cosmo.append(jnp.stack([wu.get_nz(z), wu.get_hz(z), wu.get_da(z)], axis=-1))
+        return tuple(cosmo)
+
+    @cached_property
+    def projected_tables(self) -> tuple[Optional[tuple[jax.Array, ...]], ...]:
+        """
+        Projected profile tables for each structure type, see core.model.
+        Tables are only made if tables is True and there are no stage 1 structures.
+        A structure type gets a table if it is in structure.PROJECTED_FUNCS,
+        every instance is spherical, and they all share a shape that is never fit.
+        The tables are cached in a subdirectory of cache_dir if it is set.
+        """
+        tables = [None] * len(core.ORDER)
+        if not self.tables:
+            return tuple(tables)
+        if any(STRUCT_STAGE[s.structure] == 1 for s in self.structures):
+            return tuple(tables)
+        table_dir = None
+        if self.cache_dir is not None:
+            table_dir = os.path.join(self.cache_dir, "tables")
+        for i, struct in enumerate(core.ORDER):
+            structures = [s for s in self.structures if s.structure == struct]
+            if len(structures) == 0 or struct not in PROJECTED_FUNCS:
+                continue
+            if not all(s.spherical for s in structures):
+                continue
+            par_names = list(inspect.signature(STRUCT_FUNCS[struct]).parameters)
+            shapes = [
+                [
+                    s.parameters[par_names.index(par)]
+                    for par in ("gamma", "alpha", "beta")
+                ]
+                for s in structures
+            ]
+            if any(par.fit_ever for shape in shapes for par in shape):
+                continue
+            shape = tuple(par.val for par in shapes[0])
+            if any(tuple(par.val for par in _shape) != shape for _shape in shapes):
+                continue
+            if shape[2] <= 1:
+                continue
+            log_s, log_table = wu.gnfw_projected_table(*shape, cache_dir=table_dir)
+            tables[i] = (
+                jnp.array(log_s),
+                jnp.array(log_table),
+                jnp.array(self.unit_conversion),
+            )
+        return tuple(tables)
+
+    @cached_property
+    def n_rbins(self) -> int:
+        """
+        Number of radial samples to use for the Abel projection fast path.
+        This is 0, which disables the fast path, unless all stage 0 structures
+        are spherical and there are no stage 1 structures.
+        """
+        if not self.abel:
+            return 0
+        for structure in self.structures:
+            stage = STRUCT_STAGE[structure.structure]
+            if stage == 1 or (stage == 0 and not structure.spherical):
+                return 0
+        # Roughly two samples per pixel along the diagonal of the map
+        n_diag = np.hypot(self.xyz[0].shape[0], self.xyz[1].shape[1])
+        return int(2 * np.ceil(n_diag))
+
+    @cached_property
+    def n_box(self) -> tuple[int, ...]:
+        """
+        Size of the block that stage 1 structures are evaluated on.
+        The block must contain every ellipsoid, so radii that are fit use the upper
+        bound of their prior or are scaled by cull if they have no prior.
+        This is empty, which evaluates stage 1 structures on the full grid,
+        if cull is 0, there are no stage 1 structures, or the block would be the full grid.
+        Culling is off by default since a free radius without a prior that grows
+        past the block during a fit has its structure truncated.
+        """
+        if not self.cull:
+            return ()
+        radius = 0
+        for structure in self.structures:
+            if STRUCT_STAGE[structure.structure] != 1:
+                continue
+            par_names = list(
+                inspect.signature(STRUCT_FUNCS[structure.structure]).parameters
+            )
+            for r in ("r_1", "r_2", "r_3"):
+                par = structure.parameters[par_names.index(r) - 2]
+                if not par.fit_ever:
+                    radius = max(radius, abs(par.val))
+                elif par.prior is not None:
+                    radius = max(radius, np.max(np.abs(par.prior)))
+                else:
+                    radius = max(radius, self.cull * abs(par.val))
+        if not radius:
+            return ()
+        # The x grid is in RA so it needs to be scaled to match the others
+        x = (np.ravel(self.xyz[0]) - self.xyz[3]) * np.cos(
+            self.xyz[4] / wu.rad_to_arcsec
+        )
+        grids = (x, np.ravel(self.xyz[1]), np.ravel(self.xyz[2]))
+        n_box = tuple(wu.box_size(grid, radius) for grid in grids)
+        if n_box == tuple(len(grid) for grid in grids):
+            return ()
+        return n_box
+
+    @cached_property
+    def footprint(self) -> tuple[float, float, float, float]:
+        """
+        The region of the grid that isn't affected by the edge of the beam convolution.
+        This is the grid shrunk by the half width of the beam.
+        Returned as (x_min, x_max, y_min, y_max) in the same units as the grid.
+        """
+        n_edge = self.beam.shape[0] // 2 + 1
+        x = np.sort(np.ravel(self.xyz[0]))
+        y = np.sort(np.ravel(self.xyz[1]))
+        n_edge = min(n_edge, (len(x) - 1) // 2, (len(y) - 1) // 2)
+        return x[n_edge], x[-1 - n_edge], y[n_edge], y[-1 - n_edge]
+
+    def covers(self, dx, dy) -> jax.Array:
+        """
+        Check which samples are inside the footprint of the grid.
+
+        Arguments:
+
+            dx: The RA TOD in arcseconds.
+
+            dy: The Dec TOD in arcseconds.
+
+        Returns:
+
+            inside: Boolean array that is True for samples inside the footprint.
+                    Same shape as dx.
+        """
+        x_min, x_max, y_min, y_max = self.footprint
+        return (dx >= x_min) * (dx <= x_max) * (dy >= y_min) * (dy <= y_max)
+
+    @cached_property
+    def on_grid(self) -> list[bool]:
+        """
+        Which parameters belong to structures that are evaluated on the grid.
+        If tod_stage2 is True stage 2 structures are instead evaluated at the TOD samples.
+        """
+        on_grid = []
         for structure in self.structures:
-            pars += [parameter.val for parameter in structure.parameters]
-        return pars
+            grid = not (self.tod_stage2 and STRUCT_STAGE[structure.structure] == 2)
+            on_grid += [grid] * len(structure.parameters)
+        return on_grid
+
+    @property
+    def n_stages(self) -> int:
+        """
+        Number of stages to evaluate on the grid.
+        """
+        return 2 if self.tod_stage2 else 3
+
+    @property
+    def argnums(self) -> tuple[int, ...]:
+        """
+        The argnums to pass to core.model_grad.
+        This covers every parameter that is fit in any round,
+        so the gradient is only compiled once and each round picks out its rows.
+        """
+        fit = np.array(self.to_fit_ever, dtype=bool) * np.array(
+            self.on_grid, dtype=bool
+        )
+        return tuple(np.where(fit)[0] + core.ARGNUM_SHIFT)
+
+    @property
+    def stage2_argnums(self) -> tuple[int, ...]:
+        """
+        The argnums to pass to core.stage2_tod_grad.
+        Like argnums this covers every parameter that is fit in any round.
+        """
+        fit = np.array(self.to_fit_ever, dtype=bool) * ~np.array(
+            self.on_grid, dtype=bool
+        )
+        return tuple(np.where(fit)[0] + core.STAGE2_ARGNUM_SHIFT)
+
+    @property
+    def round_argnums(self) -> tuple[int, ...]:
+        """
+        The argnums that the gradient is evaluated with this round.
+        Normally this is argnums, so the full gradient is only compiled once.
+        If this round only frees parameters in stages that can start from a cached
+        intermediate (see _evaluate_grid) then just this round's parameters are used.
+        """
+        fit = np.array(self.to_fit, dtype=bool) * np.array(self.on_grid, dtype=bool)
+        stages = self.par_stages[fit]
+        if len(stages) and (
+            np.min(stages) == 2 or (np.min(stages) == 1 and self.cube_path)
+        ):
+            return tuple(np.flatnonzero(fit) + core.ARGNUM_SHIFT)
+        return self.argnums
+
+    @property
+    def free(self) -> NDArray[np.int_]:
+        """
+        Indices of the parameters being fit this round.
+        This maps the rows of the compact gradient from to_tod_grad to parameters.
+        """
+        return np.flatnonzero(self.to_fit)
+
+    @property
+    def core_args(self) -> tuple:
+        """
+        The arguments to core.model that come before the parameters.
+        """
+        return (
+            self.xyz,
+            tuple(self.n_struct),
+            self.n_rbins,
+            self.n_zchunk,
+            self.n_box,
+            self.n_stages,
+            self.dz,
+            self.beam_ft,
+            self.cosmo,
+            self.projected_tables,
+        )
+
+    @property
+    def base_args(self) -> tuple:
+        """
+        The arguments to core.model that come before the parameters
+        for evaluating everything but the stage 2 structures.
+        """
+        return self.core_args[:5] + (2,) + self.core_args[6:]
+
+    @cached_property
+    def par_stages(self) -> NDArray[np.int_]:
+        """
+        The stage of the structure that each parameter belongs to.
+        """
+        return np.array(
+            [
+                STRUCT_STAGE[structure.structure]
+                for structure in self.structures
+                for _ in structure.parameters
+            ]
+        )
+
+    @cached_property
+    def cube_path(self) -> bool:
+        """
+        Whether the stage 0 profile is built on the full 3d grid and then modified by stage 1.
+        If so it is cached so that it can be reused while only stage 1 and 2 parameters change.
+        """
+        return (
+            not self.n_rbins
+            and not self.n_zchunk
+            and bool(np.any(self.par_stages == 1))
+        )
+
+    def compiled(self, argnums: Optional[tuple[int, ...]] = None) -> Callable:
+        """
+        Get an ahead of time compiled version of core.model or core.model_grad.
+        Each compiled function is cached so it is only built once per model,
+        with a persistent compilation cache (see core.enable_compilation_cache)
+        it can also be shared between runs and MPI ranks.
+
+        Arguments:
+
+            argnums: The argnums to compile core.model_grad with.
+                     If None then core.model is compiled instead,
+                     without the stage 2 structures (see base_args).
+
+        Returns:
+
+            compiled: The compiled function.
+                      Takes the same arguments as core.model or core.model_grad.
+        """
+        if argnums not in self._compiled:
+            pars = jnp.array(self.pars)
+            if argnums is None:
+                self._compiled[argnums] = core.compile_model(*self.base_args, *pars)
+            else:
+                self._compiled[argnums] = core.compile_model_grad(
+                    *self.core_args, argnums, *pars
+                )
+        return self._compiled[argnums]
+
+    @property
+    def pars(self) -> NDArray[np.floating]:
+        return self._par_table[:, 0].copy()
 
     @cached_property
     def par_names(self) -> list[str]:
@@ -103,11 +530,8 @@ class Model:
         return par_names
 
     @property
-    def errs(self) -> list[float]:
-        errs = []
-        for structure in self.structures:
-            errs += [parameter.err for parameter in structure.parameters]
-        return errs
+    def errs(self) -> NDArray[np.floating]:
+        return self._par_table[:, 1].copy()
 
     @cached_property
     def priors(self) -> list[Optional[tuple[float, float]]]:
@@ -117,32 +541,299 @@ class Model:
         return priors
 
     @property
-    def to_fit(self) -> list[bool]:
-        to_fit = []
-        for structure in self.structures:
-            to_fit += [
-                parameter.fit[self.cur_round] for parameter in structure.parameters
-            ]
-        return to_fit
+    def prior_bounds(self) -> NDArray[np.floating]:
+        """
+        The flat prior bounds as an (npar, 2) array.
+        Parameters without a prior are bounded by +/- inf.
+        """
+        return self._prior_table
 
-    @cached_property
-    def to_fit_ever(self) -> list[bool]:
-        to_fit = []
-        for structure in self.structures:
-            to_fit += [parameter.fit_ever for parameter in structure.parameters]
-        return to_fit
+    @property
+    def to_fit(self) -> NDArray[np.bool_]:
+        return self._fit_table[:, self.cur_round].copy()
 
-    @cached_property
+    @property
+    def to_fit_ever(self) -> NDArray[np.bool_]:
+        return np.any(self._fit_table, axis=1)
+
+    def evaluate(self, argnums: Optional[tuple[int, ...]] = None) -> list:
+        """
+        Evaluate the model, or the model and its gradient, on the grid and the nested grids.
+        Results are kept in an LRU cache keyed by the parameter values and argnums,
+        with at most cache_size entries.
+        Since the argnums are part of the key, changing rounds never returns a stale gradient.
+
+        Arguments:
+
+            argnums: The argnums to pass to core.model_grad.
+                     If None then only the model is evaluated.
+
+        Returns:
+
+            evals: The output of core.model or core.model_grad
+                   for each grid in [self] + self.nested.
+        """
+        pars = np.array(self.pars, dtype=float)
+        key = (pars.tobytes(), argnums)
+        if key not in self._evals and argnums is None:
+            # Any gradient evaluation at these parameters also has the model
+            for (_pars, _argnums), evals in self._evals.items():
+                if _pars == key[0]:
+                    return [model for model, _ in evals]
+        if key in self._evals:
+            self._evals.move_to_end(key)
+            return self._evals[key]
+
+        evals = [grid._evaluate_grid(pars, argnums) for grid in [self] + self.nested]
+        self._evals[key] = evals
+        while len(self._evals) > self.cache_size:
+            self._evals.popitem(last=False)
+        return evals
+
+    def _stage_cached(self, name: str, key: bytes, func: Callable) -> jax.Array:
+        """
+        Cache an intermediate product of the model, only the latest one is kept.
+
+        Arguments:
+
+            name: The name of the intermediate product.
+
+            key: The parameters it depends on as bytes.
+
+            func: Function that computes it on a cache miss.
+
+        Returns:
+
+            product: The intermediate product.
+        """
+        if name not in self._stages or self._stages[name][0] != key:
+            self._stages[name] = (key, func())
+        return self._stages[name][1]
+
+    def _evaluate_grid(
+        self, pars: NDArray[np.floating], argnums: Optional[tuple[int, ...]]
+    ) -> Union[jax.Array, tuple[jax.Array, jax.Array]]:
+        """
+        Evaluate the model, or the model and its gradient, on just this grid.
+        The stage 0 profile (see cube_path) and the beam convolved stage 0 and 1 profile
+        are cached keyed by the parameters of the stages they depend on,
+        so the work is only redone from the earliest stage that changed or is being fit.
+
+        Arguments:
+
+            pars: The model parameters.
+
+            argnums: The argnums to pass to core.model_grad.
+                     If None then only the model is evaluated.
+
+        Returns:
+
+            evals: The output of core.model or core.model_grad.
+        """
+        n_struct = tuple(self.n_struct)
+        stage2 = self.n_stages > 2 and bool(np.any(self.par_stages == 2))
+        jpars = jnp.array(pars)
+
+        def _pressure():
+            return self._stage_cached(
+                "pressure",
+                pars[self.par_stages == 0].tobytes(),
+                lambda: core.stage0_pressure(
+                    self.xyz, n_struct, self.cosmo, self.projected_tables, *jpars
+                ),
+            )
+
+        def _base():
+            if not self.cube_path:
+                return self.compiled()(*self.base_args, *jpars)
+            return core.model_stage1(
+                self.xyz,
+                n_struct,
+                self.n_box,
+                2,
+                self.dz,
+                self.beam_ft,
+                self.cosmo,
+                self.projected_tables,
+                _pressure(),
+                *jpars,
+            )
+
+        if argnums is None:
+            base = self._stage_cached(
+                "base", pars[self.par_stages <= 1].tobytes(), _base
+            )
+            if stage2:
+                return core.model_stage2(self.xyz, n_struct, base, *jpars)
+            return base
+
+        idx = np.array(argnums, dtype=int) - core.ARGNUM_SHIFT
+        if len(idx) == 0:
+            pred = self._evaluate_grid(pars, None)
+            return pred, jnp.zeros((0,) + pred.shape, dtype=pred.dtype)
+        first = np.min(self.par_stages[idx])
+        if first == 2:
+            base = self._stage_cached(
+                "base", pars[self.par_stages <= 1].tobytes(), _base
+            )
+            argnums = tuple(idx + core.STAGE2_GRID_ARGNUM_SHIFT)
+            return core.model_stage2_grad(self.xyz, n_struct, base, argnums, *jpars)
+        if first == 1 and self.cube_path:
+            argnums = tuple(idx + core.STAGE1_ARGNUM_SHIFT)
+            return core.model_stage1_grad(
+                self.xyz,
+                n_struct,
+                self.n_box,
+                self.n_stages,
+                self.dz,
+                self.beam_ft,
+                self.cosmo,
+                self.projected_tables,
+                _pressure(),
+                argnums,
+                *jpars,
+            )
+        return self.compiled(argnums)(*self.core_args, argnums, *jpars)
+
+    @property
     def model(self) -> jax.Array:
-        return core.model(
-            self.xyz,
-            tuple(self.n_struct),
-            self.dz,
-            self.beam,
-            *self.pars,
+        return self.evaluate()[0]
+
+    @property
+    def nested_model(self) -> list[jax.Array]:
+        """
+        The model evaluated on each of the nested grids.
+        """
+        return self.evaluate()[1:]
+
+    def model_batch(self, params, mem_limit: int = 2**30) -> jax.Array:
+        """
+        Evaluate the model for many parameter vectors in one compiled call.
+        Nominally used to get the models for all walkers in an ensemble sampler at once.
+        The stage 2 structures are always evaluated on the grid here,
+        even if tod_stage2 is set, so each model is complete.
+        This only covers the main grid, see nested_model_batch for the nested grids.
+
+        Arguments:
+
+            params: Array of parameters with shape (n_batch, npar).
+                    The parameters should be in the same order as self.pars.
+
+            mem_limit: The amount of memory in bytes to use per chunk of parameters.
+
+        Returns:
+
+            models: The model for each set of parameters.
+                    Has shape (n_batch, nx, ny).
+        """
+        n_chunk = core.batch_chunk_size(
+            self.xyz, self.n_rbins, self.n_zchunk, mem_limit
         )
+        return core.model_batch(
+            *self.core_args[:5],
+            3,
+            *self.core_args[6:],
+            n_chunk,
+            jnp.atleast_2d(jnp.array(params)),
+        )
+
+    def nested_model_batch(self, params, mem_limit: int = 2**30) -> list[jax.Array]:
+        """
+        Evaluate the model for many parameter vectors on each of the nested grids.
+        See model_batch for details.
+
+        Arguments:
+
+            params: Array of parameters with shape (n_batch, npar).
+                    The parameters should be in the same order as self.pars.
+
+            mem_limit: The amount of memory in bytes to use per chunk of parameters.
+
+        Returns:
+
+            models: The models on each nested grid,
+                    each has shape (n_batch, nx, ny) for that grid.
+        """
+        return [nest.model_batch(params, mem_limit) for nest in self.nested]
+
+    def stencil(self, dx, dy) -> tuple[jax.Array, jax.Array, Optional[jax.Array]]:
+        """
+        Precompute the interpolation stencil for a TOD.
+        Each sample uses the finest grid that covers it,
+        the indices are into the flattened grids concatenated
+        in the order [self] + self.nested.
+        The interpolation order is set by interp_order, see utils.uniform_stencil.
+
+        Arguments:
+
+            dx: The RA TOD in arcseconds.
+
+            dy: The Dec TOD in arcseconds.
+
+        Returns:
 
-    def to_tod(self, dx, dy) -> jax.Array:
+            idx: Indices of the bounding pixels.
+                 Has shape ((interp_order + 1)**2,) + dx.shape and dtype int32.
+
+            weights: The interpolation weights of the bounding pixels.
+                     Has shape ((interp_order + 1)**2,) + dx.shape and dtype float32.
+
+            perm: The permutation that sorts idx.ravel(), used for gradients.
+                  This is None when running on CPU.
+        """
+        offset = 0
+        for i, grid in enumerate([self] + self.nested):
+            xp, yp = grid.xyz[0].ravel(), grid.xyz[1].ravel()
+            _idx, _weights = wu.uniform_stencil(dx, dy, xp, yp, self.interp_order)
+            _idx = _idx + offset
+            offset += len(xp) * len(yp)
+            if i == 0:
+                idx, weights = _idx, _weights
+                continue
+            # Finer grids take over wherever they are valid
+            inside = grid.covers(dx, dy)
+            idx = jnp.where(inside, _idx, idx)
+            weights = jnp.where(inside, _weights, weights)
+
+        idx = idx.astype(jnp.int32)
+        # Sorting only pays off where the unsorted scatter is done with atomics
+        perm = None
+        if jax.default_backend() != "cpu":
+            perm = jnp.argsort(idx.ravel()).astype(jnp.int32)
+
+        return idx, weights.astype(jnp.float32), perm
+
+    def tod_stencil(self, tod: Tod) -> tuple[jax.Array, jax.Array, tuple]:
+        """
+        Get the pointing and interpolation stencil for a minkasi TOD.
+        The pointing doesn't change over a fit so this is cached by TOD name.
+        The cache is kept in host memory so that it doesn't hold device memory
+        for every TOD, each call moves the entry back to the device.
+
+        Arguments:
+
+            tod: A minkasi tod instance.
+                 'dx' and 'dy' must be in tod.info and be in radians.
+                 'fname' must also be in tod.info, it is used as the cache key.
+
+        Returns:
+
+            dx: The RA TOD in arcseconds.
+
+            dy: The Dec TOD in arcseconds.
+
+            stencil: The interpolation stencil, see Model.stencil.
+        """
+        if "fname" not in tod.info:
+            raise ValueError("TOD has no fname in its info, can't cache its stencil")
+        key = tod.info["fname"]
+        if key not in self._stencils:
+            dx = jnp.array(tod.info["dx"] * wu.rad_to_arcsec)
+            dy = jnp.array(tod.info["dy"] * wu.rad_to_arcsec)
+            self._stencils[key] = jax.device_get((dx, dy, self.stencil(dx, dy)))
+        return jax.device_put(self._stencils[key])
+
+    def to_tod(self, dx, dy, stencil=None) -> jax.Array:
         """
         Project the model into a TOD.
 
@@ -152,28 +843,41 @@ class Model:
 
             dy: The Dec TOD in arcseconds.
 
+            stencil: Precomputed interpolation stencil from Model.stencil.
+                     If None it is computed from dx and dy.
+
         Returns:
 
             tod: The model as a TOD.
                  Same shape as dx.
         """
-        return wu.bilinear_interp(
-            dx, dy, self.xyz[0].ravel(), self.xyz[1].ravel(), self.model
-        )
+        if stencil is None:
+            stencil = self.stencil(dx, dy)
+        maps = [self.model] + self.nested_model
+        tod = wu.stencil_interp(
+            jnp.concatenate([_map.ravel() for _map in maps])[None], *stencil
+        )[0]
+        if self.tod_stage2:
+            tod = tod + core.stage2_tod(
+                self.xyz, tuple(self.n_struct), dx, dy, *jnp.array(self.pars)
+            )
 
-    @cached_property
+        return tod
+
+    @property
     def model_grad(self) -> tuple[jax.Array, jax.Array]:
-        argnums = tuple(np.where(self.to_fit)[0] + core.ARGNUM_SHIFT)
-        return core.model_grad(
-            self.xyz,
-            tuple(self.n_struct),
-            self.dz,
-            self.beam,
-            argnums,
-            *self.pars,
-        )
+        return self.evaluate(self.argnums)[0]
 
-    def to_tod_grad(self, dx, dy) -> tuple[jax.Array, jax.Array]:
+    @property
+    def nested_model_grad(self) -> list[tuple[jax.Array, jax.Array]]:
+        """
+        The model and its gradient evaluated on each of the nested grids.
+        """
+        return self.evaluate(self.argnums)[1:]
+
+    def to_tod_grad(
+        self, dx, dy, stencil=None
+    ) -> tuple[jax.Array, jax.Array, NDArray[np.int_]]:
         """
         Project the model and gradient into a TOD.
 
@@ -183,32 +887,202 @@ class Model:
 
             dy: The Dec TOD in arcseconds.
 
+            stencil: Precomputed interpolation stencil from Model.stencil.
+                     If None it is computed from dx and dy.
+
         Returns:
 
             tod: The model as a TOD.
                  Same shape as dx.
 
-            grad_tod: The gradient a TOD.
-                      Has shape (npar,) + dx.shape
+            grad_tod: The gradient as a TOD for only the free parameters.
+                      Has shape (len(free),) + dx.shape
+
+            free: The index of the parameter for each row of grad_tod,
+                  see Model.free.
         """
-        model, grad = self.model_grad
-        tod = wu.bilinear_interp(
-            dx, dy, self.xyz[0].ravel(), self.xyz[1].ravel(), model
-        )
-        grad_tod = jnp.array(
+        if stencil is None:
+            stencil = self.stencil(dx, dy)
+        free = self.free
+        fit = np.array(self.to_fit, dtype=bool)
+        fit_ever = np.array(self.to_fit_ever, dtype=bool)
+        on_grid = np.array(self.on_grid, dtype=bool)
+        # The gradients may cover every round, pick out the rows for this one
+        argnums = self.round_argnums
+        in_grad = np.zeros_like(fit)
+        in_grad[np.array(argnums, dtype=int) - core.ARGNUM_SHIFT] = True
+        rows = np.flatnonzero(fit[in_grad])
+        rows_stage2 = np.flatnonzero(fit[fit_ever * ~on_grid])
+        on_grid = on_grid[free]
+        # Gather the model and all free gradient planes in one go
+        planes = jnp.concatenate(
             [
-                (
-                    wu.bilinear_interp(
-                        dx, dy, self.xyz[0].ravel(), self.xyz[1].ravel(), _grad
-                    )
-                    if _fit
-                    else jnp.zeros_like(tod)
+                jnp.concatenate((model[None], grad[rows])).reshape((len(rows) + 1, -1))
+                for model, grad in self.evaluate(argnums)
+            ],
+            axis=1,
+        )
+        planes = wu.stencil_interp(planes, *stencil)
+        tod = planes[0]
+        grad_tod = planes[1:]
+
+        if self.tod_stage2:
+            argnums = self.stage2_argnums
+            core_args = (self.xyz, tuple(self.n_struct), dx, dy)
+            pars = jnp.array(self.pars)
+            if len(rows_stage2):
+                _tod, _grad_tod = core.stage2_tod_grad(*core_args, argnums, *pars)
+                _grad_tod = _grad_tod[rows_stage2]
+                grad_tod = (
+                    jnp.zeros((len(free),) + tod.shape, dtype=tod.dtype)
+                    .at[np.flatnonzero(on_grid)]
+                    .set(grad_tod)
+                    .at[np.flatnonzero(~on_grid)]
+                    .set(_grad_tod)
                 )
-                for _grad, _fit in zip(grad, self.to_fit)
-            ]
+            else:
+                _tod = core.stage2_tod(*core_args, *pars)
+            tod = tod + _tod
+
+        return tod, grad_tod, free
+
+    def tod_chisq(self, params, tods: list[tuple]) -> jax.Array:
+        """
+        Compute the chi squared of the model against a set of TODs.
+        Unlike to_tod this is a pure function of params,
+        so it can be differentiated in reverse mode, see tod_chisq_grad.
+        The model is evaluated once on each grid and shared by all the TODs.
+
+        Arguments:
+
+            params: 1D array of all the model parameters.
+
+            tods: The TODs to compare against.
+                  Each entry is (dx, dy, stencil, data, noise),
+                  where dx, dy, and stencil are from tod_stencil
+                  and data and noise are passed to core.chisq.
+
+        Returns:
+
+            chisq: The chi squared summed over all the TODs.
+        """
+        params = jnp.array(params)
+        maps = [core.model(*grid.core_args, *params) for grid in [self] + self.nested]
+        maps = jnp.concatenate([_map.ravel() for _map in maps])[None]
+        chisq = 0.0
+        for dx, dy, stencil, data, noise in tods:
+            pred = wu.stencil_interp(maps, *stencil)[0]
+            if self.tod_stage2:
+                pred = pred + core.stage2_tod(
+                    self.xyz, tuple(self.n_struct), dx, dy, *params
+                )
+            chisq = chisq + core.chisq(data, pred, noise)
+
+        return chisq
+
+    def tod_chisq_grad(self, tods: list[tuple]) -> tuple[jax.Array, jax.Array]:
+        """
+        Compute the chi squared and its gradient at the current parameters.
+        The gradient is computed in reverse mode so the cost is a few model evaluations
+        no matter how many parameters are free, rather than one per free parameter
+        like model_grad. The stage 0 and 1 cube is checkpointed in core.model,
+        so it is recomputed in the backwards pass rather than stored.
+
+        Arguments:
+
+            tods: The TODs to compare against, see tod_chisq.
+
+        Returns:
+
+            chisq: The chi squared summed over all the TODs.
+
+            grad: The gradient of the chi squared with respect to the free parameters,
+                  in the order of Model.free.
+        """
+        chisq, grad = jax.value_and_grad(self.tod_chisq)(jnp.array(self.pars), tods)
+
+        return chisq, grad[self.free]
+
+    def precision_report(self) -> dict[str, float]:
+        """
+        Compare the model and its gradient against a float64 evaluation.
+        This is useful to check if it is safe to evaluate the model at a lower precision.
+
+        Returns:
+
+            report: The maximum error of the model and of the gradient for each parameter
+                    that is fit in any round.
+                    Each error is relative to the peak of the float64 result.
+        """
+        xyz = (
+            self.xyz[0],
+            self.xyz[1],
+            self.xyz[2].astype(jnp.float64),
+            self.xyz[3],
+            self.xyz[4],
+        )
+        pred_64, grad_64 = core.model_grad(
+            xyz, *self.core_args[1:], self.argnums, *self.pars
         )
+        pred, grad = self.model_grad
+
+        def _rel_err(val, val_64):
+            return float(jnp.max(jnp.abs(val - val_64)) / jnp.max(jnp.abs(val_64)))
+
+        report = {"model": _rel_err(pred, pred_64)}
+        for i, _grad, _grad_64 in zip(
+            np.array(self.argnums) - core.ARGNUM_SHIFT, grad, grad_64
+        ):
+            report[self.par_names[i]] = _rel_err(_grad, _grad_64)
+
+        return report
+
+    def is_linear(self, rtol: float = 1e-4, seed: int = 0) -> bool:
+        """
+        Check if the model is linear in the parameters being fit this round.
+        This is done by taking a large random step in the free parameters
+        and checking that the change in the model matches the gradient.
+        The step is scaled so that each parameter changes the model by about as much as its peak.
+        The model is evaluated at every grid pixel so everything that goes into to_tod is checked.
+
+        Arguments:
 
-        return tod, grad_tod
+            rtol: Tolerance on the mismatch relative to the change in the model.
+
+            seed: Seed for the random step.
+
+        Returns:
+
+            linear: True if the model is linear in the free parameters.
+        """
+        if not np.any(self.to_fit):
+            return False
+        dx, dy = np.meshgrid(
+            np.ravel(self.xyz[0]), np.ravel(self.xyz[1]), indexing="ij"
+        )
+        pars = np.array(self.pars)
+        errs = self.errs
+        chisq = self.chisq
+
+        pred, grad, free = self.to_tod_grad(dx, dy)
+        # Scale the step so each parameter changes the model by about its peak
+        grad_max = np.max(np.abs(np.array(grad)), axis=(1, 2))
+        if np.any(grad_max == 0):
+            return False
+        rng = np.random.default_rng(seed)
+        step = rng.uniform(0.5, 1.5, len(free)) * np.max(np.abs(pred)) / grad_max
+        pars_step = pars.copy()
+        pars_step[free] += step
+        self.update(pars_step, errs, chisq)
+        pred_step = self.to_tod(dx, dy)
+        self.update(pars, errs, chisq)
+
+        delta = np.array(pred_step - pred)
+        linear = np.array(jnp.tensordot(step, grad, axes=1))
+        scale = np.max(np.abs(delta))
+        if scale == 0:
+            return False
+        return bool(np.max(np.abs(delta - linear)) <= rtol * scale)
 
     def __repr__(self) -> str:
         rep = self.name + ":\n"
@@ -232,19 +1106,12 @@ class Model:
         return rep
 
     def update(self, vals, errs, chisq):
-        if not np.array_equal(self.pars, vals):
-            self.__dict__.pop("model", None)
-            self.__dict__.pop("model_grad", None)
-        n = 0
-        for struct in self.structures:
-            for par in struct.parameters:
-                par.val = vals[n]
-                par.err = errs[n]
-                n += 1
+        self._par_table[:, 0] = vals
+        self._par_table[:, 1] = errs
         self.chisq = chisq
 
     def minkasi_helper(
-        self, params: NDArray[np.floating], tod: Tod
+        self, params: NDArray[np.floating], tod: Tod, compact: bool = False
     ) -> tuple[NDArray[np.floating], NDArray[np.floating]]:
         """
         Helper function to work with minkasi fitting routines.
@@ -252,23 +1119,35 @@ class Model:
         Arguments:
 
             params: An array of model parameters.
+                    If compact is True this should only have the free parameters,
+                    in the order given by self.free.
 
             tod: A minkasi tod instance.
                 'dx' and 'dy' must be in tod.info and be in radians.
 
+            compact: If True only the free parameters are passed in and out.
+                     Otherwise the gradient is padded with zeros for the fixed parameters.
+
         Returns:
 
             grad: The gradient of the model with respect to the model parameters.
+                  If compact is True this only has rows for the free parameters.
 
             pred: The model with the specified substructure.
         """
+        if compact:
+            pars = self.pars
+            pars[self.free] = params
+            params = pars
         self.update(params, self.errs, self.chisq)
-        dx = tod.info["dx"] * wu.rad_to_arcsec
-        dy = tod.info["dy"] * wu.rad_to_arcsec
 
-        pred_tod, grad_tod = self.to_tod_grad(dx, dy)
+        pred_tod, grad_tod, free = self.to_tod_grad(*self.tod_stencil(tod))
         pred_tod = jax.device_get(pred_tod)
         grad_tod = jax.device_get(grad_tod)
+        if not compact:
+            grad_padded = np.zeros((len(params),) + pred_tod.shape, grad_tod.dtype)
+            grad_padded[free] = grad_tod
+            grad_tod = grad_padded
 
         return grad_tod, pred_tod
 
@@ -320,6 +1199,18 @@ class Model:
             name: eval(str(const)) for name, const in cfg.get("constants", {}).items()
         }  # pyright: ignore [reportUnusedVariable]
 
+        # Setup the persistent compilation cache
+        cache_dir = cfg.get(
+            "jax_cache",
+            os.path.join(
+                os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+                "witch",
+            ),
+        )
+        if cache_dir:
+            cache_dir = os.path.expanduser(cache_dir)
+            core.enable_compilation_cache(cache_dir)
+
         # Get jax device
         dev_id = cfg.get("jax_device", 0)
         device = jax.devices()[dev_id]
@@ -331,8 +1222,31 @@ class Model:
         x0 = eval(str(cfg["coords"]["x0"]))
         y0 = eval(str(cfg["coords"]["y0"]))
 
+        # Setup line of sight quadrature
+        # If this isn't provided then we just use the trapezoid rule with spacing dz
+        los = cfg["coords"].get("los", None)
+        z = None
+        if los is not None:
+            z, dz = wu.make_los(
+                r_map,
+                dz,
+                los.get("method", "uniform"),
+                los.get("n_z", None),
+                eval(str(los.get("stretch", 0.0))),
+            )
+
         xyz_host = wu.make_grid(
-            r_map, dr, dr, dz, x0 * wu.rad_to_arcsec, y0 * wu.rad_to_arcsec
+            r_map, dr, dr, dz, x0 * wu.rad_to_arcsec, y0 * wu.rad_to_arcsec, z
+        )
+        # The precision of the z grid sets the precision of the 3d model
+        # x and y contain the absolute position of the grid so they stay in float64
+        precision = cfg.get("precision", "float64")
+        xyz_host = (
+            xyz_host[0],
+            xyz_host[1],
+            xyz_host[2].astype(precision),
+            xyz_host[3],
+            xyz_host[4],
         )
         xyz = jax.device_put(xyz_host, device)
         xyz[0].block_until_ready()
@@ -348,9 +1262,45 @@ class Model:
             eval(str(cfg["beam"]["amp2"])),
         )
         beam = jax.device_put(beam, device)
+        linear_conv = cfg["beam"].get("linear", False)
+
+        # Setup finer grids nested inside the main one, these should go from coarse to fine
+        # They share the line of sight samples of the main grid
+        nested_grids = []
+        for nest in cfg["coords"].get("nested", []):
+            nest_dr = eval(str(nest["dr"]))
+            nest_xyz = wu.make_grid(
+                eval(str(nest["r_map"])),
+                nest_dr,
+                nest_dr,
+                None,
+                x0 * wu.rad_to_arcsec,
+                y0 * wu.rad_to_arcsec,
+                xyz_host[2].ravel(),
+            )
+            nest_beam = wu.beam_double_gauss(
+                nest_dr,
+                eval(str(cfg["beam"]["fwhm1"])),
+                eval(str(cfg["beam"]["amp1"])),
+                eval(str(cfg["beam"]["fwhm2"])),
+                eval(str(cfg["beam"]["amp2"])),
+            )
+            nested_grids.append(
+                (jax.device_put(nest_xyz, device), jax.device_put(nest_beam, device))
+            )
 
         n_rounds = cfg.get("n_rounds", 1)
-        dz = dz * eval(str(cfg["model"]["unit_conversion"]))
+        unit_conversion = eval(str(cfg["model"]["unit_conversion"]))
+        dz = dz * unit_conversion
+        if los is not None:
+            dz = jax.device_put(dz, device)
+        abel = cfg["coords"].get("abel", True)
+        n_zchunk = cfg["coords"].get("n_zchunk", 0)
+        cull = cfg["coords"].get("cull", 0.0)
+        tod_stage2 = cfg["model"].get("tod_stage2", False)
+        tables = cfg["coords"].get("tables", False)
+        interp_order = cfg["coords"].get("interp_order", 1)
+        cache_size = cfg["model"].get("cache_size", 4)
 
         structures = []
         for name, structure in cfg["model"]["structures"].items():
@@ -373,4 +1323,44 @@ class Model:
             "name", "-".join([structure.name for structure in structures])
         )
 
-        return cls(name, structures, xyz, dz, beam, n_rounds)
+        nested = [
+            cls(
+                f"{name}_nested{i}",
+                structures,
+                nest_xyz,
+                dz,
+                nest_beam,
+                n_rounds,
+                abel=abel,
+                n_zchunk=n_zchunk,
+                cull=cull,
+                linear_conv=linear_conv,
+                tod_stage2=tod_stage2,
+                tables=tables,
+                unit_conversion=unit_conversion,
+                cache_dir=cache_dir or None,
+                interp_order=interp_order,
+                cache_size=cache_size,
+            )
+            for i, (nest_xyz, nest_beam) in enumerate(nested_grids)
+        ]
+
+        return cls(
+            name,
+            structures,
+            xyz,
+            dz,
+            beam,
+            n_rounds,
+            abel=abel,
+            n_zchunk=n_zchunk,
+            cull=cull,
+            linear_conv=linear_conv,
+            tod_stage2=tod_stage2,
+            tables=tables,
+            unit_conversion=unit_conversion,
+            cache_dir=cache_dir or None,
+            interp_order=interp_order,
+            cache_size=cache_size,
+            nested=nested,
+        )
@@ -3,19 +3,15 @@ Core module for generating models aed their gradients.
 """
 
 import inspect
+import os
+from functools import partial
 
 import jax
 import jax.numpy as jnp
-
-if hasattr(jnp, "trapz"):
-    trapz = jnp.trapz
-else:
-    from jax.scipy.integrate import trapezoid as trapz
-
 import numpy as np
 
-from .structure import STRUCT_FUNCS, STRUCT_N_PAR, STRUCT_STAGE
-from .utils import fft_conv
+from .structure import PROJECTED_FUNCS, STRUCT_FUNCS, STRUCT_N_PAR, STRUCT_STAGE
+from .utils import fft_conv, fft_conv_ft, rad_to_arcsec, transform_grid
 
 ORDER = (
     "isobeta",
@@ -62,11 +58,534 @@ def _check_order():
         raise ValueError("ORDER seems to have elements with stages out of order")
 
 
+def _stage_pars(n_structs, params, stage):
+    """
+    Iterate over the structure types in a stage along with their parameters.
+
+    Arguments:
+
+        n_structs: Number of each structure to use.
+                   Should be in the same order as `order`.
+
+        params: 1D array of model parameters.
+
+        stage: The stage to get structures from.
+
+    Yields:
+
+        struct: The name of the structure.
+
+        struct_pars: The parameters for each instance of the structure.
+                     Has shape (n_struct, n_par).
+    """
+    start = 0
+    for n_struct, struct in zip(n_structs, ORDER):
+        delta = n_struct * STRUCT_N_PAR[struct]
+        if n_struct and STRUCT_STAGE[struct] == stage:
+            yield struct, params[start : start + delta].reshape(
+                (n_struct, STRUCT_N_PAR[struct])
+            )
+        start += delta
+
+
+def _modify(pressure, xyz, n_box, struct, struct_pars):
+    """
+    Apply a stage 1 structure to the 3d grid.
+    If n_box is set the structure is only evaluated on a block around its center.
+
+    Arguments:
+
+        pressure: The 3d pressure profile to modify.
+
+        xyz: Coordinate grid that pressure is evaluated on.
+
+        n_box: The number of samples along each axis of the block.
+               If empty the full grid is used.
+
+        struct: The name of the structure.
+
+        struct_pars: The parameters of the structure.
+                     The first three are assumed to be the offset of its center.
+
+    Returns:
+
+        pressure: The modified pressure profile.
+    """
+    if not n_box:
+        return STRUCT_FUNCS[struct](pressure, xyz, *struct_pars)
+    # The grid may be a slab that is smaller than the box
+    n_box = tuple(min(n, s) for n, s in zip(n_box, pressure.shape))
+
+    # Find the sample nearest the center along each axis
+    # Clamp so the block stays inside the grid if it hangs off the edge,
+    # dynamic_slice would wrap a negative start around to the far edge
+    center = (
+        xyz[3] + struct_pars[0] / jnp.cos(xyz[4] / rad_to_arcsec),
+        xyz[4] + struct_pars[1],
+        struct_pars[2],
+    )
+    start = tuple(
+        jnp.clip(jnp.argmin(jnp.abs(grid.ravel() - c)) - n // 2, 0, s - n).astype(
+            jnp.int32
+        )
+        for grid, c, n, s in zip(xyz[:3], center, n_box, pressure.shape)
+    )
+    zero = jnp.int32(0)
+    xyz_box = (
+        jax.lax.dynamic_slice(xyz[0], (start[0], zero, zero), (n_box[0], 1, 1)),
+        jax.lax.dynamic_slice(xyz[1], (zero, start[1], zero), (1, n_box[1], 1)),
+        jax.lax.dynamic_slice(xyz[2], (zero, zero, start[2]), (1, 1, n_box[2])),
+        xyz[3],
+        xyz[4],
+    )
+    box = jax.lax.dynamic_slice(pressure, start, n_box)
+    box = STRUCT_FUNCS[struct](box, xyz_box, *struct_pars)
+
+    return jax.lax.dynamic_update_slice(pressure, box, start)
+
+
+def _stage0_pressure(xyz, n_structs, cosmo, tables, params):
+    """
+    Evaluate stage 0 structures on a 3d grid.
+
+    Arguments:
+
+        xyz: Coordinate grid to compute profile on.
+
+        n_structs: Number of each structure to use.
+                   Should be in the same order as `order`.
+
+        cosmo: Precomputed cosmology for each structure type, see model.
+
+        tables: Projected profile tables for each structure type, see model.
+                Structures with a table are skipped.
+
+        params: 1D array of model parameters.
+                Should be at the precision of the z grid.
+
+    Returns:
+
+        pressure: The 3d pressure profile.
+    """
+    pressure = jnp.zeros(
+        (xyz[0].shape[0], xyz[1].shape[1], xyz[2].shape[2]), dtype=xyz[2].dtype
+    )
+    for struct, struct_pars in _stage_pars(n_structs, params, 0):
+        if tables[ORDER.index(struct)] is not None:
+            continue
+        # All structures of this type are evaluated with one vmapped kernel
+        pressure = jnp.add(
+            pressure,
+            _vmap_sum(
+                STRUCT_FUNCS[struct],
+                struct_pars,
+                xyz,
+                _struct_cosmo(cosmo, struct, xyz[2].dtype),
+            ),
+        )
+
+    return pressure
+
+
+def _stage1_modify(pressure, xyz, n_structs, n_box, params):
+    """
+    Apply stage 1 structures to a 3d grid.
+
+    Arguments:
+
+        pressure: The 3d pressure profile to modify.
+
+        xyz: Coordinate grid that pressure is evaluated on.
+
+        n_structs: Number of each structure to use.
+                   Should be in the same order as `order`.
+
+        n_box: Size of the block that stage 1 structures are evaluated on, see model.
+
+        params: 1D array of model parameters.
+                Should be at the precision of the z grid.
+
+    Returns:
+
+        pressure: The modified pressure profile.
+    """
+    for struct, struct_pars in _stage_pars(n_structs, params, 1):
+        # Modifiers don't commute so scan over them in order
+        pressure, _ = jax.lax.scan(
+            lambda pressure, pars: (_modify(pressure, xyz, n_box, struct, pars), None),
+            pressure,
+            struct_pars,
+        )
+
+    return pressure
+
+
+def _pressure(xyz, n_structs, n_box, cosmo, tables, params):
+    """
+    Evaluate stage 0 and stage 1 structures on a 3d grid.
+    This is done at the precision of the z grid.
+
+    Arguments:
+
+        xyz: Coordinate grid to compute profile on.
+
+        n_structs: Number of each structure to use.
+                   Should be in the same order as `order`.
+
+        n_box: Size of the block that stage 1 structures are evaluated on, see model.
+
+        cosmo: Precomputed cosmology for each structure type, see model.
+
+        tables: Projected profile tables for each structure type, see model.
+                Structures with a table are skipped.
+
+        params: 1D array of model parameters.
+
+    Returns:
+
+        pressure: The 3d pressure profile with substructure.
+    """
+    params = params.astype(xyz[2].dtype)
+    pressure = _stage0_pressure(xyz, n_structs, cosmo, tables, params)
+
+    return _stage1_modify(pressure, xyz, n_structs, n_box, params)
+
+
+def _los_weights(dz, n_z):
+    """
+    Get the quadrature weight for each sample along the line of sight.
+
+    Arguments:
+
+        dz: Either a scalar spacing for the trapezoid rule
+            or an array of quadrature weights for each sample along the line of sight.
+
+        n_z: The number of samples along the line of sight.
+
+    Returns:
+
+        weights: The quadrature weights, has shape (n_z,).
+    """
+    if jnp.ndim(dz) == 0:
+        weights = jnp.full(n_z, dz)
+        return weights.at[jnp.array([0, -1])].multiply(0.5)
+    return jnp.ravel(dz)
+
+
+def _stream_integrate(xyz, n_structs, n_zchunk, n_box, dz, cosmo, tables, params):
+    """
+    Evaluate stage 0 and stage 1 structures and integrate along the line of sight
+    one slab of n_zchunk samples at a time.
+    Only one slab of the 3d grid is ever in memory so peak memory
+    scales with nx * ny * n_zchunk rather than nx * ny * nz.
+
+    Arguments:
+
+        xyz: Coordinate grid to compute profile on.
+
+        n_structs: Number of each structure to use.
+                   Should be in the same order as `order`.
+
+        n_zchunk: The number of samples along the line of sight in each slab.
+
+        n_box: Size of the block that stage 1 structures are evaluated on, see model.
+
+        dz: Factor to scale by while integrating or quadrature weights.
+
+        cosmo: Precomputed cosmology for each structure type, see model.
+
+        tables: Projected profile tables for each structure type, see model.
+
+        params: 1D array of model parameters.
+
+    Returns:
+
+        ip: The integrated profile.
+    """
+    z = xyz[2].ravel()
+    weights = _los_weights(dz, len(z))
+
+    # Pad with zero weight so we have an integer number of slabs
+    n_pad = (-1 * len(z)) % n_zchunk
+    z = jnp.pad(z, (0, n_pad), mode="edge").reshape((-1, 1, 1, n_zchunk))
+    weights = jnp.pad(weights, (0, n_pad)).reshape((-1, n_zchunk))
+
+    def _slab(ip, slab):
+        z_slab, w_slab = slab
+        pressure = _pressure(
+            (xyz[0], xyz[1], z_slab, xyz[3], xyz[4]),
+            n_structs,
+            n_box,
+            cosmo,
+            tables,
+            params,
+        )
+        return ip + _integrate(pressure, w_slab), None
+
+    # Checkpoint each slab so reverse mode doesn't keep every slab around
+    ip, _ = jax.lax.scan(
+        jax.checkpoint(_slab),
+        jnp.zeros((xyz[0].shape[0], xyz[1].shape[1])),
+        (z, weights),
+    )
+
+    return ip
+
+
+def _integrate(pressure, dz):
+    """
+    Integrate along the line of sight, which is the last axis.
+    The sum is always accumulated in float64, even if the pressure is lower precision.
+
+    Arguments:
+
+        pressure: The pressure to integrate.
+
+        dz: Either a scalar spacing for the trapezoid rule
+            or an array of quadrature weights for each sample along the line of sight.
+
+    Returns:
+
+        ip: The integrated pressure.
+    """
+    weights = _los_weights(dz, pressure.shape[-1]).astype(pressure.dtype)
+    return jnp.sum(pressure * weights, axis=-1, dtype=jnp.float64)
+
+
+def _struct_cosmo(cosmo, struct, dtype):
+    """
+    Get the precomputed cosmology for a structure type.
+
+    Arguments:
+
+        cosmo: Precomputed cosmology for each structure type, see model.
+
+        struct: The name of the structure.
+
+        dtype: The dtype to cast to.
+
+    Returns:
+
+        struct_cosmo: The cosmology for each instance of the structure.
+                      None if it isn't precomputed.
+    """
+    struct_cosmo = cosmo[ORDER.index(struct)]
+    if struct_cosmo is None:
+        return None
+    return jnp.asarray(struct_cosmo, dtype=dtype)
+
+
+def _call(func, pars, xyz, struct_cosmo):
+    """
+    Evaluate a structure, passing in its precomputed cosmology if we have it.
+
+    Arguments:
+
+        func: The structure function to evaluate.
+
+        pars: The parameters of the structure.
+
+        xyz: Coordinate grid to compute the structure on.
+
+        struct_cosmo: Precomputed cosmology for this structure, can be None.
+
+    Returns:
+
+        profile: The structure evaluated on xyz.
+    """
+    if struct_cosmo is None:
+        return func(*pars, xyz)
+    return func(*pars, xyz, struct_cosmo)
+
+
+def _vmap_sum(func, struct_pars, xyz, struct_cosmo=None):
+    """
+    Evaluate all instances of a structure with a single vmapped kernel and sum them.
+    This keeps the traced graph the same size no matter how many instances there are.
+
+    Arguments:
+
+        func: The structure function to evaluate.
+
+        struct_pars: The parameters for each instance of the structure.
+                     Should have shape (n_struct, n_par).
+
+        xyz: Coordinate grid to compute the structure on.
+
+        struct_cosmo: Precomputed cosmology for each instance of the structure.
+                      Should have shape (n_struct, 3) or be None.
+
+    Returns:
+
+        summed: The sum of all instances of the structure.
+    """
+    if struct_pars.shape[0] == 1:
+        return _call(
+            func, struct_pars[0], xyz, jax.tree.map(lambda c: c[0], struct_cosmo)
+        )
+    return jnp.sum(
+        jax.vmap(lambda pars, c: _call(func, pars, xyz, c))(struct_pars, struct_cosmo),
+        axis=0,
+    )
+
+
+def _radial_grid(xyz, n_rbins):
+    """
+    Make a radial grid that spans every projected separation on the map.
+    The samples are spaced quadratically so that the cusp at the center is well resolved.
+    The returned coordinate grid is built such that transform_grid maps it
+    to x = r and y = 0 for a structure centered at the grid origin.
+
+    Arguments:
+
+        xyz: Coordinate grid that the model is being computed on.
+
+        n_rbins: Number of radial samples to use.
+
+    Returns:
+
+        r: The radial samples, should be 1D.
+
+        xyz_r: Coordinate grid with shape (n_rbins, 1, nz) to compute profiles on.
+    """
+    x0, y0 = xyz[3], xyz[4]
+    cos_y0 = jnp.cos(y0 / rad_to_arcsec)
+    x = xyz[0].ravel()
+    y = xyz[1].ravel()
+    # Small margin to account for the declination stretch varying with dy
+    r_max = 1.01 * jnp.sqrt(((x[-1] - x[0]) * cos_y0) ** 2 + (y[-1] - y[0]) ** 2)
+    r = r_max * jnp.linspace(0, 1, n_rbins) ** 2
+
+    xyz_r = (
+        (x0 + r / cos_y0)[:, None, None],
+        jnp.full((1, 1, 1), y0),
+        xyz[2],
+        x0,
+        y0,
+    )
+
+    return r, xyz_r
+
+
+def _abel_project(xyz, r, xyz_r, dz, struct, struct_pars, struct_cosmo):
+    """
+    Project a spherically symmetric stage 0 structure onto the map.
+    The profile is evaluated once along a radial line and integrated along the
+    line of sight, the result is then interpolated onto the projected radius of each pixel.
+
+    Arguments:
+
+        xyz: Coordinate grid to compute the projected profile on.
+
+        r: The radial samples from _radial_grid.
+
+        xyz_r: The radial coordinate grid from _radial_grid.
+
+        dz: Factor to scale by while integrating or quadrature weights.
+
+        struct: The name of the structure to project.
+
+        struct_pars: The parameters of the structure.
+                     The first two must be the RA and Dec offsets.
+
+        struct_cosmo: Precomputed cosmology for the structure, can be None.
+
+    Returns:
+
+        ip: The integrated profile evaluated on the grid.
+    """
+    pars = jnp.concatenate((jnp.zeros(2, struct_pars.dtype), struct_pars[2:]))
+    profile = _call(STRUCT_FUNCS[struct], pars, xyz_r, struct_cosmo)
+    profile = _integrate(profile, dz).ravel()
+
+    x, y, _ = transform_grid(struct_pars[0], struct_pars[1], 0, 1, 1, 1, 0, xyz)
+    rr = jnp.sqrt(x**2 + y**2)[..., 0]
+
+    return jnp.interp(rr, r, profile)
+
+
+def _project_and_convolve(ip, xyz, n_structs, beam, cosmo, tables, params):
+    """
+    Add the stage 0 structures that have a projected table
+    to the integrated profile and convolve with the beam.
+
+    Arguments:
+
+        ip: The integrated profile.
+
+        xyz: Coordinate grid the profile is on.
+
+        n_structs: Number of each structure to use.
+                   Should be in the same order as `order`.
+
+        beam: Beam to convolve by, see model.
+
+        cosmo: Precomputed cosmology for each structure type, see model.
+
+        tables: Projected profile tables for each structure type, see model.
+
+        params: 1D array of model parameters.
+
+    Returns:
+
+        ip: The beam convolved profile.
+    """
+    # Stage 0 structures with a table go straight onto the 2d grid
+    for struct, struct_pars in _stage_pars(n_structs, params, 0):
+        table = tables[ORDER.index(struct)]
+        if table is None:
+            continue
+        log_s, log_table, conversion = table
+        projected = _vmap_sum(
+            partial(PROJECTED_FUNCS[struct], table=(log_s, log_table)),
+            struct_pars,
+            xyz,
+            _struct_cosmo(cosmo, struct, struct_pars.dtype),
+        )
+        ip = jnp.add(ip, conversion * projected)
+
+    # Convolve with the beam, using its transform directly if we were given it
+    if jnp.iscomplexobj(beam):
+        return fft_conv_ft(ip, beam)
+    return fft_conv(ip, beam)
+
+
+def _add_stage2(ip, xyz, n_structs, params):
+    """
+    Add the stage 2 structures to the beam convolved profile.
+
+    Arguments:
+
+        ip: The beam convolved profile.
+
+        xyz: Coordinate grid the profile is on.
+
+        n_structs: Number of each structure to use.
+                   Should be in the same order as `order`.
+
+        params: 1D array of model parameters.
+
+    Returns:
+
+        ip: The profile with the stage 2 structures.
+    """
+    for struct, struct_pars in _stage_pars(n_structs, params, 2):
+        ip = jnp.add(ip, _vmap_sum(STRUCT_FUNCS[struct], struct_pars, xyz))
+
+    return ip
+
+
 def model(
     xyz,
     n_structs,
+    n_rbins,
+    n_zchunk,
+    n_box,
+    n_stages,
     dz,
     beam,
+    cosmo,
+    tables,
     *params,
 ):
     """
@@ -75,15 +594,54 @@ def model(
     Arguments:
 
         xyz: Coordinate grid to compute profile on.
+             Stage 0 and stage 1 are computed at the precision of the z grid,
+             the integral along the line of sight is always accumulated in float64.
 
         n_struct: Number of each structure to use.
                   Should be in the same order as `order`.
 
+        n_rbins: Number of radial samples to use for the Abel projection fast path.
+                 If nonzero every stage 0 structure is assumed to be spherically symmetric
+                 and is integrated along a single radial line rather than on the full 3d grid.
+                 Set to 0 to always use the full 3d grid.
+                 Models with stage 1 structures can not use the fast path.
+
+        n_zchunk: Number of samples along the line of sight to evaluate at once.
+                  If nonzero the 3d grid is built and integrated one slab at a time,
+                  which bounds the peak memory use.
+                  Set to 0 to build the full 3d grid at once.
+                  Ignored if n_rbins is nonzero.
+
+        n_box: Number of samples along each axis of the block that stage 1 structures are evaluated on.
+               Each block is centered on its structure, so it should be large enough to contain
+               the ellipsoid for every set of parameters that will be tried.
+               Set to an empty tuple to evaluate stage 1 structures on the full grid.
+
+        n_stages: Number of stages to evaluate on the grid.
+                  Set to 2 to skip stage 2, for example if it is evaluated with stage2_tod instead.
+
         dz: Factor to scale by while integrating.
             Since it is a global factor it can contain unit conversions.
             Historically equal to y2K_RJ * dr * da * XMpc / me.
+            Can also be an array of quadrature weights, one for each sample along the line of sight
+            with the unit conversion included. See utils.make_los.
 
         beam: Beam to convolve by, should be a 2d array.
+              Can also be the precomputed transform of the beam from utils.kernel_fft.
+
+        cosmo: Precomputed cosmology for each structure type, in the same order as `order`.
+               Each entry is either an array with shape (n_struct, 3) containing
+               n(z), h(z), and da(z) for each instance of the structure, or None.
+               If None the structure computes these from its redshift parameter,
+               so this should be None for structures where the redshift is fit
+               or that don't use cosmology.
+
+        tables: Projected profile tables for each structure type, in the same order as `order`.
+                Each entry is either None or a tuple of (log_s, log_table, conversion),
+                where log_s and log_table are from utils.gnfw_projected_table
+                and conversion is the unit conversion to apply to the projected profile.
+                Stage 0 structures with a table are projected with structure.PROJECTED_FUNCS
+                rather than integrated on the grid.
 
         params: 1D array of model parameters.
 
@@ -94,66 +652,47 @@ def model(
     params = jnp.array(params)
     params = jnp.ravel(params)  # Fixes strange bug with params having dim (1,n)
 
-    pressure = jnp.zeros((xyz[0].shape[0], xyz[1].shape[1], xyz[2].shape[2]))
-    start = 0
-
-    # Stage 0, add to the 3d grid
-    for n_struct, struct in zip(n_structs, ORDER):
-        if STRUCT_STAGE[struct] != 0:
-            continue
-        if not n_struct:
-            continue
-        delta = n_struct * STRUCT_N_PAR[struct]
-        struct_pars = params[start : start + delta].reshape(
-            (n_struct, STRUCT_N_PAR[struct])
-        )
-        start += delta
-        for i in range(n_struct):
-            pressure = jnp.add(pressure, STRUCT_FUNCS[struct](*struct_pars[i], xyz))
-
-    # Stage 1, modify the 3d grid
-    for n_struct, struct in zip(n_structs, ORDER):
-        if STRUCT_STAGE[struct] != 1:
-            continue
-        if not n_struct:
-            continue
-        delta = n_struct * STRUCT_N_PAR[struct]
-        struct_pars = params[start : start + delta].reshape(
-            (n_struct, STRUCT_N_PAR[struct])
+    if n_rbins:
+        for _ in _stage_pars(n_structs, params, 1):
+            raise ValueError("Can't use Abel projection with stage 1 structures")
+        # Stage 0, project each structure directly onto the 2d grid
+        r, xyz_r = _radial_grid(xyz, n_rbins)
+        ip = jnp.zeros((xyz[0].shape[0], xyz[1].shape[1]))
+        stage_pars = _stage_pars(n_structs, params.astype(xyz[2].dtype), 0)
+        for struct, struct_pars in stage_pars:
+            if tables[ORDER.index(struct)] is not None:
+                continue
+            # All structures of this type are evaluated with one vmapped kernel
+            ip = jnp.add(
+                ip,
+                jnp.sum(
+                    jax.vmap(
+                        lambda pars, c: _abel_project(
+                            xyz, r, xyz_r, dz, struct, pars, c
+                        )
+                    )(struct_pars, _struct_cosmo(cosmo, struct, xyz[2].dtype)),
+                    axis=0,
+                ),
+            )
+    elif n_zchunk:
+        # Stages 0 and 1 one slab at a time, integrating as we go
+        ip = _stream_integrate(
+            xyz, n_structs, n_zchunk, n_box, dz, cosmo, tables, params
         )
-        start += delta
-        for i in range(n_struct):
-            pressure = STRUCT_FUNCS[struct](pressure, xyz, *struct_pars[i])
-
-    # Integrate along line of site
-    ip = trapz(pressure, dx=dz, axis=-1)
-
-    bound0, bound1 = int((ip.shape[0] - beam.shape[0]) / 2), int(
-        (ip.shape[1] - beam.shape[1]) / 2
-    )
-    beam = jnp.pad(
-        beam,
-        (
-            (bound0, ip.shape[0] - beam.shape[0] - bound0),
-            (bound1, ip.shape[1] - beam.shape[1] - bound1),
-        ),
-    )
+    else:
+        # Stages 0 and 1 on the full 3d grid, then integrate along line of site
+        # Checkpointed so reverse mode recomputes the cube rather than storing it
+        ip = jax.checkpoint(
+            lambda params: _integrate(
+                _pressure(xyz, n_structs, n_box, cosmo, tables, params), dz
+            )
+        )(params)
 
-    ip = fft_conv(ip, beam)
+    ip = _project_and_convolve(ip, xyz, n_structs, beam, cosmo, tables, params)
 
     # Stage 2, add to the integrated profile
-    for n_struct, struct in zip(n_structs, ORDER):
-        if STRUCT_STAGE[struct] != 2:
-            continue
-        if not n_struct:
-            continue
-        delta = n_struct * STRUCT_N_PAR[struct]
-        struct_pars = params[start : start + delta].reshape(
-            (n_struct, STRUCT_N_PAR[struct])
-        )
-        start += delta
-        for i in range(n_struct):
-            ip = jnp.add(ip, STRUCT_FUNCS[struct](*struct_pars[i], xyz))
+    if n_stages > 2:
+        ip = _add_stage2(ip, xyz, n_structs, params)
 
     return ip
 
@@ -161,8 +700,14 @@ def model(
 def model_grad(
     xyz,
     n_structs,
+    n_rbins,
+    n_zchunk,
+    n_box,
+    n_stages,
     dz,
     beam,
+    cosmo,
+    tables,
     argnums,
     *params,
 ):
@@ -179,27 +724,425 @@ def model_grad(
 
         model: The model with the specified substructure.
 
-        grad: The gradient of the model with respect to the model parameters.
+        grad: The gradient of the model with respect to the parameters in argnums.
+              Has shape (len(argnums),) + model.shape,
+              row i is for parameter argnums[i] - ARGNUM_SHIFT.
     """
     pred = model(
         xyz,
         n_structs,
+        n_rbins,
+        n_zchunk,
+        n_box,
+        n_stages,
         dz,
         beam,
+        cosmo,
+        tables,
         *params,
     )
+    if len(argnums) == 0:
+        return pred, jnp.zeros((0,) + pred.shape, dtype=pred.dtype)
 
     grad = jax.jacfwd(model, argnums=argnums)(
         xyz,
         n_structs,
+        n_rbins,
+        n_zchunk,
+        n_box,
+        n_stages,
         dz,
         beam,
+        cosmo,
+        tables,
         *params,
     )
-    grad_padded = jnp.zeros((len(params),) + pred.shape)
-    grad_padded = grad_padded.at[jnp.array(argnums) - ARGNUM_SHIFT].set(jnp.array(grad))
 
-    return pred, grad_padded
+    return pred, jnp.array(grad)
+
+
+def model_batch(
+    xyz,
+    n_structs,
+    n_rbins,
+    n_zchunk,
+    n_box,
+    n_stages,
+    dz,
+    beam,
+    cosmo,
+    tables,
+    n_chunk,
+    params,
+):
+    """
+    Evaluate model for many parameter vectors in a single call.
+    This is useful for ensemble samplers where every walker needs a model each step.
+    Only the additional arguments are described here, see model for the others.
+
+    Arguments:
+
+        n_chunk: How many parameter vectors to evaluate at once.
+                 The batch is split into chunks of this size which are evaluated in sequence,
+                 so this controls the peak memory usage. See batch_chunk_size.
+
+        params: 2D array of model parameters with shape (n_batch, npar).
+
+    Returns:
+
+        models: The model for each parameter vector.
+                Has shape (n_batch, nx, ny).
+    """
+    params = jnp.atleast_2d(params)
+    n_batch = params.shape[0]
+    n_chunk = min(n_chunk, n_batch)
+
+    # Pad so that we have an integer number of chunks
+    n_pad = (-1 * n_batch) % n_chunk
+    params = jnp.pad(params, ((0, n_pad), (0, 0)), mode="edge")
+    params = params.reshape((-1, n_chunk, params.shape[-1]))
+
+    def _model(pars):
+        return model(
+            xyz,
+            n_structs,
+            n_rbins,
+            n_zchunk,
+            n_box,
+            n_stages,
+            dz,
+            beam,
+            cosmo,
+            tables,
+            *pars,
+        )
+
+    models = jax.lax.map(jax.vmap(_model), params)
+    models = models.reshape((-1,) + models.shape[2:])
+
+    return models[:n_batch]
+
+
+def stage0_pressure(xyz, n_structs, cosmo, tables, *params):
+    """
+    Evaluate just the stage 0 structures on the full 3d grid.
+    This lets the 3d profile be reused by model_stage1 while only
+    the stage 1 and stage 2 parameters change.
+    See model for a description of the arguments.
+
+    Returns:
+
+        pressure: The 3d pressure profile at the precision of the z grid.
+    """
+    params = jnp.ravel(jnp.array(params)).astype(xyz[2].dtype)
+
+    return _stage0_pressure(xyz, n_structs, cosmo, tables, params)
+
+
+def model_stage1(
+    xyz, n_structs, n_box, n_stages, dz, beam, cosmo, tables, pressure, *params
+):
+    """
+    Finish the model starting from a precomputed stage 0 profile.
+    This is the same as model on the full 3d grid,
+    but the stage 0 parameters are only used for structures with a projected table.
+    Only the additional arguments are described here, see model for the others.
+
+    Arguments:
+
+        pressure: The stage 0 profile from stage0_pressure.
+
+    Returns:
+
+        model: The model with the specified substructure evaluated on the grid.
+    """
+    params = jnp.ravel(jnp.array(params))
+    pressure = _stage1_modify(
+        pressure, xyz, n_structs, n_box, params.astype(xyz[2].dtype)
+    )
+    ip = _integrate(pressure, dz)
+    ip = _project_and_convolve(ip, xyz, n_structs, beam, cosmo, tables, params)
+    if n_stages > 2:
+        ip = _add_stage2(ip, xyz, n_structs, params)
+
+    return ip
+
+
+def model_stage1_grad(
+    xyz, n_structs, n_box, n_stages, dz, beam, cosmo, tables, pressure, argnums, *params
+):
+    """
+    A wrapper around model_stage1 that also returns the gradients.
+    Only the additional arguments are described here, see model_stage1 for the others.
+    Note that the additional arguments are passed **before** the *params argument.
+    The gradient doesn't include the dependence of pressure on the stage 0 parameters,
+    so argnums should only point at stage 1 and stage 2 parameters.
+
+    Arguments:
+
+        argnums: The arguments to evaluate the gradient at
+
+    Returns:
+
+        model: The model with the specified substructure.
+
+        grad: The gradient of the model with respect to the parameters in argnums.
+              Has shape (len(argnums),) + model.shape,
+              row i is for parameter argnums[i] - STAGE1_ARGNUM_SHIFT.
+    """
+    args = (xyz, n_structs, n_box, n_stages, dz, beam, cosmo, tables, pressure)
+    pred = model_stage1(*args, *params)
+    if len(argnums) == 0:
+        return pred, jnp.zeros((0,) + pred.shape, dtype=pred.dtype)
+    grad = jax.jacfwd(model_stage1, argnums=argnums)(*args, *params)
+
+    return pred, jnp.array(grad)
+
+
+def model_stage2(xyz, n_structs, ip, *params):
+    """
+    Add the stage 2 structures to a precomputed beam convolved profile.
+    The profile should be from model with n_stages set to 2.
+    Only the additional arguments are described here, see model for the others.
+
+    Arguments:
+
+        ip: The beam convolved profile of the stage 0 and stage 1 structures.
+
+    Returns:
+
+        model: The model with the specified substructure evaluated on the grid.
+    """
+    params = jnp.ravel(jnp.array(params))
+
+    return _add_stage2(ip, xyz, n_structs, params)
+
+
+def model_stage2_grad(xyz, n_structs, ip, argnums, *params):
+    """
+    A wrapper around model_stage2 that also returns the gradients.
+    Only the additional arguments are described here, see model_stage2 for the others.
+    Note that the additional arguments are passed **before** the *params argument.
+    Since ip is fixed argnums should only point at stage 2 parameters.
+
+    Arguments:
+
+        argnums: The arguments to evaluate the gradient at
+
+    Returns:
+
+        model: The model with the specified substructure.
+
+        grad: The gradient of the model with respect to the parameters in argnums.
+              Has shape (len(argnums),) + model.shape,
+              row i is for parameter argnums[i] - STAGE2_GRID_ARGNUM_SHIFT.
+    """
+    pred = model_stage2(xyz, n_structs, ip, *params)
+    if len(argnums) == 0:
+        return pred, jnp.zeros((0,) + pred.shape, dtype=pred.dtype)
+    grad = jax.jacfwd(model_stage2, argnums=argnums)(xyz, n_structs, ip, *params)
+
+    return pred, jnp.array(grad)
+
+
+def batch_chunk_size(xyz, n_rbins, n_zchunk, mem_limit=2**30):
+    """
+    Estimate how many parameter vectors model_batch can evaluate at once.
+
+    Arguments:
+
+        xyz: Coordinate grid to compute profile on.
+
+        n_rbins: Number of radial samples used by the Abel projection fast path.
+
+        n_zchunk: Number of samples along the line of sight evaluated at once.
+
+        mem_limit: The amount of memory in bytes we can use for each chunk.
+
+    Returns:
+
+        n_chunk: The number of parameter vectors to evaluate at once.
+    """
+    nx, ny, nz = xyz[0].shape[0], xyz[1].shape[1], xyz[2].shape[2]
+    if n_rbins:
+        n_cells = n_rbins * nz + nx * ny
+    elif n_zchunk:
+        n_cells = nx * ny * min(n_zchunk, nz)
+    else:
+        n_cells = nx * ny * nz
+    # Leave some headroom for temporaries made while evaluating
+    per_model = 4 * n_cells * jnp.dtype(xyz[2].dtype).itemsize
+
+    return max(1, int(mem_limit // per_model))
+
+
+def stage2_tod(xyz, n_structs, dx, dy, *params):
+    """
+    Evaluate the stage 2 structures directly at the TOD sample positions.
+    Since these are analytic this avoids interpolating them off of the grid.
+
+    Arguments:
+
+        xyz: Coordinate grid the model is computed on.
+             Only the grid origin is used.
+
+        n_structs: Number of each structure to use.
+                   Should be in the same order as `order`.
+
+        dx: The RA TOD in arcseconds.
+
+        dy: The Dec TOD in arcseconds.
+
+        params: 1D array of model parameters.
+
+    Returns:
+
+        tod: The stage 2 structures as a TOD.
+             Same shape as dx.
+    """
+    params = jnp.array(params)
+    params = jnp.ravel(params)
+
+    # Treat the samples as a grid with a single z sample so the structures can be reused
+    xyz_tod = (dx[..., None], dy[..., None], jnp.zeros(1), xyz[3], xyz[4])
+    tod = jnp.zeros(dx.shape)
+    for struct, struct_pars in _stage_pars(n_structs, params, 2):
+        tod = jnp.add(tod, _vmap_sum(STRUCT_FUNCS[struct], struct_pars, xyz_tod))
+
+    return tod
+
+
+def stage2_tod_grad(xyz, n_structs, dx, dy, argnums, *params):
+    """
+    A wrapper around stage2_tod that also returns the gradients.
+    Only the additional arguments are described here, see stage2_tod for the others.
+    Note that the additional arguments are passed **before** the *params argument.
+
+    Arguments:
+
+        argnums: The arguments to evaluate the gradient at
+
+    Returns:
+
+        tod: The stage 2 structures as a TOD.
+
+        grad_tod: The gradient of the TOD with respect to the parameters in argnums.
+                  Has shape (len(argnums),) + dx.shape,
+                  row i is for parameter argnums[i] - STAGE2_ARGNUM_SHIFT.
+    """
+    pred = stage2_tod(xyz, n_structs, dx, dy, *params)
+    if len(argnums) == 0:
+        return pred, jnp.zeros((0,) + pred.shape, dtype=pred.dtype)
+
+    grad = jax.jacfwd(stage2_tod, argnums=argnums)(xyz, n_structs, dx, dy, *params)
+
+    return pred, jnp.array(grad)
+
+
+def chisq(data, pred, noise):
+    """
+    Compute the chi squared of a model TOD against the data.
+    This is a plain jax function so it can be differentiated in reverse mode.
+
+    Arguments:
+
+        data: The data TOD, with samples along the last axis.
+
+        pred: The model TOD, same shape as data.
+
+        noise: The noise weight to apply to the residual.
+               If it has the same shape as data it is a diagonal weight,
+               for example the inverse variance of each sample.
+               Otherwise it is a Fourier weight with shape data.shape[:-1] + (n_samp // 2 + 1,),
+               for example the inverse noise power spectrum of each detector,
+               that multiplies the rfft of the residual along the last axis.
+
+    Returns:
+
+        chisq: The chi squared, resid . noise(resid).
+    """
+    resid = data - pred
+    if noise.shape == resid.shape:
+        resid_filt = resid * noise
+    else:
+        resid_filt = jnp.fft.irfft(
+            jnp.fft.rfft(resid, axis=-1) * noise, n=resid.shape[-1], axis=-1
+        )
+
+    return jnp.sum(resid * resid_filt)
+
+
+def _aot(func, static_argnums, *args):
+    """
+    Lower and compile a jitted function ahead of time.
+
+    Arguments:
+
+        func: The jitted function to compile.
+
+        static_argnums: The static arguments of func.
+
+        *args: The arguments to compile func for.
+
+    Returns:
+
+        compiled: Function that calls the compiled executable.
+                  It takes the same arguments as func, including the static ones,
+                  but they must match the ones it was compiled with.
+    """
+    executable = func.lower(*args).compile()
+
+    def compiled(*args):
+        return executable(
+            *[arg for i, arg in enumerate(args) if i not in static_argnums]
+        )
+
+    return compiled
+
+
+def compile_model(*args):
+    """
+    Ahead of time compile model for a given set of arguments.
+
+    Arguments:
+
+        *args: The arguments to model.
+
+    Returns:
+
+        compiled: The compiled version of model, see _aot for details.
+    """
+    return _aot(model, model_static, *args)
+
+
+def compile_model_grad(*args):
+    """
+    Ahead of time compile model_grad for a given set of arguments.
+
+    Arguments:
+
+        *args: The arguments to model_grad.
+
+    Returns:
+
+        compiled: The compiled version of model_grad, see _aot for details.
+    """
+    return _aot(model_grad, model_grad_static, *args)
+
+
+def enable_compilation_cache(cache_dir):
+    """
+    Turn on the persistent compilation cache.
+    Compiled executables are stored on disk keyed by their HLO,
+    which includes the static arguments like n_structs and argnums,
+    so reruns and other MPI ranks with the same model can skip compiling.
+
+    Arguments:
+
+        cache_dir: Directory to store the cache in.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    jax.config.update("jax_compilation_cache_dir", cache_dir)
 
 
 # Check that ORDER is ok...
@@ -208,14 +1151,42 @@ _check_order()
 # Do some signature inspection to avoid hard coding
 model_sig = inspect.signature(model)
 model_grad_sig = inspect.signature(model_grad)
+model_batch_sig = inspect.signature(model_batch)
+stage0_pressure_sig = inspect.signature(stage0_pressure)
+model_stage1_sig = inspect.signature(model_stage1)
+model_stage1_grad_sig = inspect.signature(model_stage1_grad)
+model_stage2_sig = inspect.signature(model_stage2)
+model_stage2_grad_sig = inspect.signature(model_stage2_grad)
+stage2_tod_sig = inspect.signature(stage2_tod)
+stage2_tod_grad_sig = inspect.signature(stage2_tod_grad)
 
 # Get argnum shifts, -1 is for param
 ARGNUM_SHIFT = len(model_sig.parameters) - 1
+STAGE2_ARGNUM_SHIFT = len(stage2_tod_sig.parameters) - 1
+STAGE1_ARGNUM_SHIFT = len(model_stage1_sig.parameters) - 1
+STAGE2_GRID_ARGNUM_SHIFT = len(model_stage2_sig.parameters) - 1
 
 # Figure out static argnums
 model_static = _get_static(model_sig)
 model_grad_static = _get_static(model_grad_sig)
+model_batch_static = _get_static(model_batch_sig)
+stage0_pressure_static = _get_static(stage0_pressure_sig)
+model_stage1_static = _get_static(model_stage1_sig)
+model_stage1_grad_static = _get_static(model_stage1_grad_sig)
+model_stage2_static = _get_static(model_stage2_sig)
+model_stage2_grad_static = _get_static(model_stage2_grad_sig)
+stage2_tod_static = _get_static(stage2_tod_sig)
+stage2_tod_grad_static = _get_static(stage2_tod_grad_sig)
 
 # Now JIT
 model = jax.jit(model, static_argnums=model_static)
 model_grad = jax.jit(model_grad, static_argnums=model_grad_static)
+model_batch = jax.jit(model_batch, static_argnums=model_batch_static)
+stage0_pressure = jax.jit(stage0_pressure, static_argnums=stage0_pressure_static)
+model_stage1 = jax.jit(model_stage1, static_argnums=model_stage1_static)
+model_stage1_grad = jax.jit(model_stage1_grad, static_argnums=model_stage1_grad_static)
+model_stage2 = jax.jit(model_stage2, static_argnums=model_stage2_static)
+model_stage2_grad = jax.jit(model_stage2_grad, static_argnums=model_stage2_grad_static)
+stage2_tod = jax.jit(stage2_tod, static_argnums=stage2_tod_static)
+stage2_tod_grad = jax.jit(stage2_tod_grad, static_argnums=stage2_tod_grad_static)
+chisq = jax.jit(chisq)
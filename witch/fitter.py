@@ -9,6 +9,7 @@ import os
 import sys
 import time
 from copy import deepcopy
+from functools import partial
 
 import minkasi
 import numpy as np
@@ -17,7 +18,6 @@ from minkasi.tools import presets_by_source as pbs
 
 from . import core
 from . import mapmaking as mm
-from . import utils as wu
 from .containers import Model
 
 
@@ -136,9 +136,7 @@ def process_tods(
                     (minkasi.myrank + minkasi.nproc * i) % 2
                 )
 
-            pred = model.to_tod(
-                tod.info["dx"] * wu.rad_to_arcsec, tod.info["dy"] * wu.rad_to_arcsec
-            )
+            pred = model.to_tod(*model.tod_stencil(tod))
             tod.info["dat_calib"] += np.array(pred)
 
         tod.set_noise(noise_class, *noise_args, **noise_kwargs)
@@ -147,6 +145,77 @@ def process_tods(
     return ""
 
 
+def fit_linear(model, todvec):
+    """
+    Fit a model that is linear in its free parameters.
+    The gradient of the model is a fixed template for each free parameter,
+    so the normal equations can be built and solved with a single pass over the data.
+
+    Arguments:
+
+        model: The model to fit, should be linear in the parameters being fit this round.
+               See Model.is_linear.
+
+        todvec: The TODs to fit to, the noise should already be set.
+
+    Returns:
+
+        pars: The fit parameters.
+
+        chisq: The chi squared of the fit.
+
+        errs: The errors on the parameters.
+              Parameters that were not fit keep their existing error.
+    """
+    free = model.free
+    pars = model.pars
+    n_fit = len(free)
+
+    lhs = np.zeros((n_fit, n_fit))
+    rhs = np.zeros(n_fit)
+    chisq = 0.0
+    for tod in todvec.tods:
+        templates, pred = model.minkasi_helper(pars[free], tod, compact=True)
+        resid = tod.info["dat_calib"] - pred
+        resid_filt = tod.apply_noise(resid)
+        chisq += np.sum(resid * resid_filt)
+        for i, template in enumerate(templates):
+            rhs[i] += np.sum(template * resid_filt)
+            template_filt = tod.apply_noise(template)
+            lhs[i] += np.sum(template_filt[None, ...] * templates, axis=(1, 2))
+    if minkasi.nproc > 1:
+        lhs = minkasi.comm.allreduce(lhs)
+        rhs = minkasi.comm.allreduce(rhs)
+        chisq = minkasi.comm.allreduce(chisq)
+
+    # Since the model is linear the step to the best fit is exact
+    cov = np.linalg.inv(lhs)
+    step = cov @ rhs
+    pars[free] += step
+    chisq -= step @ rhs
+    errs = model.errs
+    errs[free] = np.sqrt(np.diag(cov))
+
+    return pars, chisq, errs
+
+
+def _in_priors(pars, bounds):
+    """
+    Check if parameters are within their flat priors.
+
+    Arguments:
+
+        pars: The parameters to check.
+
+        bounds: The prior bounds for each parameter, see Model.prior_bounds.
+
+    Returns:
+
+        in_priors: True if every parameter is within its prior.
+    """
+    return bool(np.all((pars >= bounds[:, 0]) * (pars <= bounds[:, 1])))
+
+
 def get_outdir(cfg, bowl_str, model):
     name = model.name + ("_ns" * (not cfg["sub"]))
     outroot = cfg["paths"]["outroot"]
@@ -246,9 +315,15 @@ def main():
 
     # Define the model and get stuff setup for minkasi
     model = Model.from_cfg(cfg)
-    funs = [model.minkasi_helper]
+    if cfg.get("precision", "float64") != "float64":
+        print_once(
+            f"Model precision is {cfg['precision']}, errors relative to float64:"
+        )
+        for name, err in model.precision_report().items():
+            print_once(f"\t{name}: {err:.3e}")
+    # Only the free parameters are passed to minkasi so it never sees the fixed ones
+    funs = [partial(model.minkasi_helper, compact=True)]
     params = np.array(model.pars)
-    npars = np.array([len(params)])
     prior_vals = model.priors
     priors = [None if prior is None else "flat" for prior in prior_vals]
 
@@ -298,21 +373,34 @@ def main():
                 f"Starting round {i+1} of fitting with {np.sum(to_fit)} pars free"
             )
             t1 = time.time()
-            (
-                pars_fit,
-                chisq,
-                _,
-                errs,
-            ) = minkasi.fitting.fit_timestreams_with_derivs_manyfun(
-                funs,
-                model.pars,
-                npars,
-                todvec,
-                to_fit,
-                maxiter=cfg["minkasi"]["maxiter"],
-                priors=priors,
-                prior_vals=prior_vals,
-            )
+            linear = cfg["minkasi"].get("linear", True) and model.is_linear()
+            if linear:
+                print_once("Model is linear in the free pars, solving directly")
+                pars_fit, chisq, errs = fit_linear(model, todvec)
+                if not _in_priors(pars_fit, model.prior_bounds):
+                    print_once("Linear solution is outside the priors, iterating")
+                    linear = False
+            if not linear:
+                free = model.free
+                (
+                    pars_free,
+                    chisq,
+                    _,
+                    errs_free,
+                ) = minkasi.fitting.fit_timestreams_with_derivs_manyfun(
+                    funs,
+                    model.pars[free],
+                    np.array([len(free)]),
+                    todvec,
+                    np.ones(len(free), dtype=bool),
+                    maxiter=cfg["minkasi"]["maxiter"],
+                    priors=[priors[j] for j in free],
+                    prior_vals=[prior_vals[j] for j in free],
+                )
+                pars_fit = model.pars
+                pars_fit[free] = pars_free
+                errs = model.errs
+                errs[free] = errs_free
             minkasi.comm.barrier()
             t2 = time.time()
             print_once("Took", t2 - t1, "seconds to fit")
@@ -328,10 +416,7 @@ def main():
 
             # Reestimate noise
             for i, tod in enumerate(todvec.tods):
-                pred = model.to_tod(
-                    tod.info["dx"] * wu.rad_to_arcsec,
-                    tod.info["dy"] * wu.rad_to_arcsec,
-                )
+                pred = model.to_tod(*model.tod_stencil(tod))
 
                 tod.set_noise(
                     noise_class,
@@ -347,10 +432,7 @@ def main():
 
     # Compute residual and either set it to the data or use it for noise
     for i, tod in enumerate(todvec.tods):
-        pred = model.to_tod(
-            tod.info["dx"] * wu.rad_to_arcsec,
-            tod.info["dy"] * wu.rad_to_arcsec,
-        )
+        pred = model.to_tod(*model.tod_stencil(tod))
         if cfg["sub"]:
             tod.info["dat_calib"] -= np.array(pred)
             tod.set_noise(noise_class, *noise_args, **noise_kwargs)
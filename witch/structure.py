@@ -12,8 +12,101 @@ import jax.numpy as jnp
 from .utils import ap, get_da, get_hz, get_nz, h70, transform_grid
 
 
+@jax.custom_jvp
+def _gnfw_shape(r, gamma, alpha, beta):
+    """
+    Radial shape of a gNFW profile.
+    Has a hand written JVP so that the gradient reuses the primal terms.
+
+    Arguments:
+
+        r: Scaled radius, should be r/rs.
+
+        gamma: The central slope
+
+        alpha: The intermediate slope
+
+        beta: The outer slope
+
+    Returns:
+
+        shape: 1/((r**gamma) * (1 + r**alpha) ** ((beta - gamma) / alpha))
+    """
+    denominator = (r**gamma) * (1 + r**alpha) ** ((beta - gamma) / alpha)
+    return 1 / denominator
+
+
+@_gnfw_shape.defjvp
+def _gnfw_shape_jvp(primals, tangents):
+    r, gamma, alpha, beta = primals
+    dr, dgamma, dalpha, dbeta = tangents
+
+    # These only depend on the primals, so under jacfwd they are computed once
+    # and each parameter just costs a few multiplies
+    log_r = jnp.log(r)
+    r_alpha = r**alpha
+    log_1p = jnp.log1p(r_alpha)
+    ratio = r_alpha / (1 + r_alpha)
+    shape = 1 / ((r**gamma) * jnp.exp(((beta - gamma) / alpha) * log_1p))
+
+    d_r = -1 * shape * (gamma + (beta - gamma) * ratio) / r
+    d_gamma = shape * (log_1p / alpha - log_r)
+    d_alpha = shape * ((beta - gamma) / alpha) * (log_1p / alpha - ratio * log_r)
+    d_beta = -1 * shape * log_1p / alpha
+
+    return shape, d_r * dr + d_gamma * dgamma + d_alpha * dalpha + d_beta * dbeta
+
+
+@jax.custom_jvp
+def _isobeta_shape(rr, beta):
+    """
+    Radial shape of an isobeta profile.
+    Has a hand written JVP so that the gradient reuses the primal terms.
+
+    Arguments:
+
+        rr: The squared scaled radius plus 1.
+
+        beta: Beta value of isobeta model
+
+    Returns:
+
+        shape: rr ** (-1.5 * beta)
+    """
+    return rr ** (-1.5 * beta)
+
+
+@_isobeta_shape.defjvp
+def _isobeta_shape_jvp(primals, tangents):
+    rr, beta = primals
+    drr, dbeta = tangents
+
+    shape = _isobeta_shape(rr, beta)
+    d_rr = -1.5 * beta * shape / rr
+    d_beta = -1.5 * shape * jnp.log(rr)
+
+    return shape, d_rr * drr + d_beta * dbeta
+
+
 @jax.jit
-def gnfw(dx, dy, dz, r_1, r_2, r_3, theta, P0, c500, m500, gamma, alpha, beta, z, xyz):
+def gnfw(
+    dx,
+    dy,
+    dz,
+    r_1,
+    r_2,
+    r_3,
+    theta,
+    P0,
+    c500,
+    m500,
+    gamma,
+    alpha,
+    beta,
+    z,
+    xyz,
+    cosmo=None,
+):
     """
     Elliptical gNFW pressure profile in 3d.
     This function does not include smoothing or declination stretch
@@ -51,19 +144,22 @@ def gnfw(dx, dy, dz, r_1, r_2, r_3, theta, P0, c500, m500, gamma, alpha, beta, z
 
         xyz: Coordinte grid to calculate model on
 
+        cosmo: Precomputed n(z), h(z), and da(z) at the redshift of the cluster.
+               If None they are computed from z, this is needed to fit z.
+
     Returns:
 
         model: The gnfw model
     """
-    nz = get_nz(z)
-    hz = get_hz(z)
+    if cosmo is None:
+        cosmo = (get_nz(z), get_hz(z), get_da(z))
+    nz, hz, _ = cosmo
 
     x, y, z = transform_grid(dx, dy, dz, r_1, r_2, r_3, theta, xyz)
 
     r500 = (m500 / (4.00 * jnp.pi / 3.00) / 5.00e02 / nz) ** (1.00 / 3.00)
 
     r = c500 * jnp.sqrt(x**2 + y**2 + z**2) / r500
-    denominator = (r**gamma) * (1 + r**alpha) ** ((beta - gamma) / alpha)
 
     P500 = (
         1.65e-03
@@ -72,11 +168,11 @@ def gnfw(dx, dy, dz, r_1, r_2, r_3, theta, P0, c500, m500, gamma, alpha, beta, z
         * h70**2
     )
 
-    return P500 * P0 / denominator
+    return P500 * P0 * _gnfw_shape(r, gamma, alpha, beta)
 
 
 @jax.jit
-def a10(dx, dy, dz, theta, P0, c500, m500, gamma, alpha, beta, z, xyz):
+def a10(dx, dy, dz, theta, P0, c500, m500, gamma, alpha, beta, z, xyz, cosmo=None):
     """
     gNFW pressure profile in 3d based on Arnaud2010.
     Compared to the function gnfw, this function fixes r1/r2/r3 to r500.
@@ -109,14 +205,16 @@ def a10(dx, dy, dz, theta, P0, c500, m500, gamma, alpha, beta, z, xyz):
 
         xyz: Coordinte grid to calculate model on
 
+        cosmo: Precomputed n(z), h(z), and da(z) at the redshift of the cluster.
+               If None they are computed from z, this is needed to fit z.
+
     Returns:
 
         model: The gnfw model
     """
-
-    nz = get_nz(z)
-    hz = get_hz(z)
-    da = get_da(z)  # TODO pass these arguments rather than recompute them everytime???
+    if cosmo is None:
+        cosmo = (get_nz(z), get_hz(z), get_da(z))
+    nz, hz, da = cosmo
 
     r500 = (m500 / (4.00 * jnp.pi / 3.00) / 5.00e02 / nz) ** (1.00 / 3.00)
     r_1, r_2, r_3 = r500 / da, r500 / da, r500 / da
@@ -124,7 +222,6 @@ def a10(dx, dy, dz, theta, P0, c500, m500, gamma, alpha, beta, z, xyz):
     x, y, z = transform_grid(dx, dy, dz, r_1, r_2, r_3, theta, xyz)
 
     r = c500 * jnp.sqrt(x**2 + y**2 + z**2)
-    denominator = (r**gamma) * (1 + r**alpha) ** ((beta - gamma) / alpha)
 
     P500 = (
         1.65e-03
@@ -133,11 +230,28 @@ def a10(dx, dy, dz, theta, P0, c500, m500, gamma, alpha, beta, z, xyz):
         * h70**2
     )
 
-    return P500 * P0 / denominator
+    return P500 * P0 * _gnfw_shape(r, gamma, alpha, beta)
 
 
 @jax.jit
-def ea10(dx, dy, dz, r_1, r_2, r_3, theta, P0, c500, m500, gamma, alpha, beta, z, xyz):
+def ea10(
+    dx,
+    dy,
+    dz,
+    r_1,
+    r_2,
+    r_3,
+    theta,
+    P0,
+    c500,
+    m500,
+    gamma,
+    alpha,
+    beta,
+    z,
+    xyz,
+    cosmo=None,
+):
     """
     Eliptical gNFW pressure profile in 3d based on Arnaud2010.
     r_ell is computed in the usual way for an a10 profile, then the axes are
@@ -177,13 +291,16 @@ def ea10(dx, dy, dz, r_1, r_2, r_3, theta, P0, c500, m500, gamma, alpha, beta, z
 
         xyz: Coordinte grid to calculate model on
 
+        cosmo: Precomputed n(z), h(z), and da(z) at the redshift of the cluster.
+               If None they are computed from z, this is needed to fit z.
+
     Returns:
 
         model: The gnfw model
     """
-    nz = get_nz(z)
-    hz = get_hz(z)
-    da = get_da(z)  # TODO pass these arguments rather than recompute them everytime???
+    if cosmo is None:
+        cosmo = (get_nz(z), get_hz(z), get_da(z))
+    nz, hz, da = cosmo
 
     r500 = (m500 / (4.00 * jnp.pi / 3.00) / 5.00e02 / nz) ** (1.00 / 3.00)
     r_ell = r500 / da
@@ -196,7 +313,6 @@ def ea10(dx, dy, dz, r_1, r_2, r_3, theta, P0, c500, m500, gamma, alpha, beta, z
     x, y, z = transform_grid(dx, dy, dz, r_1, r_2, r_3, theta, xyz)
 
     r = c500 * jnp.sqrt(x**2 + y**2 + z**2)
-    denominator = (r**gamma) * (1 + r**alpha) ** ((beta - gamma) / alpha)
 
     P500 = (
         1.65e-03
@@ -205,7 +321,7 @@ def ea10(dx, dy, dz, r_1, r_2, r_3, theta, P0, c500, m500, gamma, alpha, beta, z
         * h70**2
     )
 
-    return P500 * P0 / denominator
+    return P500 * P0 * _gnfw_shape(r, gamma, alpha, beta)
 
 
 @jax.jit
@@ -244,10 +360,8 @@ def isobeta(dx, dy, dz, r_1, r_2, r_3, theta, beta, amp, xyz):
     x, y, z = transform_grid(dx, dy, dz, r_1, r_2, r_3, theta, xyz)
 
     rr = 1 + x**2 + y**2 + z**2
-    power = -1.5 * beta
-    rrpow = rr**power
 
-    return amp * rrpow
+    return amp * _isobeta_shape(rr, beta)
 
 
 @jax.jit
@@ -463,11 +577,7 @@ def add_powerlaw(
     r = jnp.sqrt(x**2 + y**2 + z**2)
     phi = abs((jnp.arctan2(y, x) - phi0) % (2 * jnp.pi) - jnp.pi) / jnp.pi
 
-    powerlaw = (
-        amp
-        * (1 - jnp.float_power(1 + r, -1.0 * k_r))
-        * (1 - jnp.float_power(1 + phi, -1 * k_phi))
-    )
+    powerlaw = amp * (1 - (1 + r) ** (-1.0 * k_r)) * (1 - (1 + phi) ** (-1 * k_phi))
     new_pressure = jnp.where(r > 1, pressure, (1 + powerlaw) * pressure)
     return new_pressure
 
@@ -515,19 +625,152 @@ def add_powerlaw_cos(
     r = jnp.sqrt(x**2 + y**2 + z**2)
     phi = (jnp.arctan2(y, x) - phi0) % (2 * jnp.pi)
 
-    powerlaw = amp * (1 - jnp.float_power(1 + r, -1.0 * k_r)) * jnp.cos(omega * phi)
+    powerlaw = amp * (1 - (1 + r) ** (-1.0 * k_r)) * jnp.cos(omega * phi)
     new_pressure = jnp.where(r > 1, pressure, (1 + powerlaw) * pressure)
     return new_pressure
 
 
+def _projected_shape(s, table):
+    """
+    Interpolate a projected profile table, see utils.gnfw_projected_table.
+
+    Arguments:
+
+        s: Scaled projected radius.
+
+        table: The log radii and log values of the table.
+
+    Returns:
+
+        projected: The projected profile at s.
+                   Radii past the end of the table are set to 0.
+    """
+    log_s, log_table = table
+    # Clip at the start of the table so the center doesn't give a nan gradient
+    s = jnp.maximum(s, jnp.exp(log_s[0]))
+    return jnp.exp(jnp.interp(jnp.log(s), log_s, log_table, right=-1 * jnp.inf))
+
+
+@jax.jit
+def gnfw_projected(
+    dx,
+    dy,
+    dz,
+    r_1,
+    r_2,
+    r_3,
+    theta,
+    P0,
+    c500,
+    m500,
+    gamma,
+    alpha,
+    beta,
+    z,
+    xyz,
+    cosmo=None,
+    table=None,
+):
+    """
+    Spherical gNFW pressure profile integrated along the line of sight.
+    This uses a precomputed table for the shape, so gamma, alpha, and beta
+    must match the ones the table was made with.
+    The line of sight integral is not truncated at the edge of the grid.
+    Takes the same arguments as gnfw, only the additional ones are described here.
+    r_1 is used as the radius, r_2, r_3, theta, and dz are ignored.
+
+    Arguments:
+
+        table: The log radii and log values of the projected profile.
+               See utils.gnfw_projected_table.
+
+    Returns:
+
+        model: The projected gnfw model, in arcseconds times the pressure units.
+    """
+    if cosmo is None:
+        cosmo = (get_nz(z), get_hz(z), get_da(z))
+    nz, hz, _ = cosmo
+
+    x, y, _ = transform_grid(dx, dy, 0, 1, 1, 1, 0, xyz)
+
+    r500 = (m500 / (4.00 * jnp.pi / 3.00) / 5.00e02 / nz) ** (1.00 / 3.00)
+    scale = r_1 * r500 / c500
+    rr = jnp.sqrt(x[..., 0] ** 2 + y[..., 0] ** 2)
+
+    P500 = (
+        1.65e-03
+        * (m500 / (3.00e14 / h70)) ** (2.00 / 3.00 + ap)
+        * hz ** (8.00 / 3.00)
+        * h70**2
+    )
+
+    return P500 * P0 * scale * _projected_shape(rr / scale, table)
+
+
+@jax.jit
+def a10_projected(
+    dx,
+    dy,
+    dz,
+    theta,
+    P0,
+    c500,
+    m500,
+    gamma,
+    alpha,
+    beta,
+    z,
+    xyz,
+    cosmo=None,
+    table=None,
+):
+    """
+    A10 pressure profile integrated along the line of sight.
+    This uses a precomputed table for the shape, so gamma, alpha, and beta
+    must match the ones the table was made with.
+    The line of sight integral is not truncated at the edge of the grid.
+    Takes the same arguments as a10, only the additional ones are described here.
+    dz and theta are ignored.
+
+    Arguments:
+
+        table: The log radii and log values of the projected profile.
+               See utils.gnfw_projected_table.
+
+    Returns:
+
+        model: The projected a10 model, in arcseconds times the pressure units.
+    """
+    if cosmo is None:
+        cosmo = (get_nz(z), get_hz(z), get_da(z))
+    nz, hz, da = cosmo
+
+    x, y, _ = transform_grid(dx, dy, 0, 1, 1, 1, 0, xyz)
+
+    r500 = (m500 / (4.00 * jnp.pi / 3.00) / 5.00e02 / nz) ** (1.00 / 3.00)
+    scale = r500 / da / c500
+    rr = jnp.sqrt(x[..., 0] ** 2 + y[..., 0] ** 2)
+
+    P500 = (
+        1.65e-03
+        * (m500 / (3.00e14 / h70)) ** (2.00 / 3.00 + ap)
+        * hz ** (8.00 / 3.00)
+        * h70**2
+    )
+
+    return P500 * P0 * scale * _projected_shape(rr / scale, table)
+
+
 # Get number of parameters for each structure
 # The -1 is because xyz doesn't count
 # -2 for Uniform, expo, and power as they also take a pressure arg that doesn't count
+# -2 for gnfw, a10, and ea10 as they also take a cosmo arg that doesn't count
 # For now a line needs to be added for each new model but this could be more magic down the line
 N_PAR_ISOBETA = len(inspect.signature(isobeta).parameters) - 1
-N_PAR_GNFW = len(inspect.signature(gnfw).parameters) - 1
-N_PAR_A10 = len(inspect.signature(a10).parameters) - 1
-N_PAR_EA10 = len(inspect.signature(ea10).parameters) - 1
+N_PAR_GNFW = len(inspect.signature(gnfw).parameters) - 2
+N_PAR_A10 = len(inspect.signature(a10).parameters) - 2
+N_PAR_EA10 = len(inspect.signature(ea10).parameters) - 2
 N_PAR_GAUSSIAN = len(inspect.signature(gaussian).parameters) - 1
 N_PAR_EGAUSSIAN = len(inspect.signature(egaussian).parameters) - 1
 N_PAR_UNIFORM = len(inspect.signature(add_uniform).parameters) - 2
@@ -571,3 +814,9 @@ STRUCT_STAGE = {
     "gnfw": 0,
     "isobeta": 0,
 }
+
+# Structures that can be projected with utils.gnfw_projected_table
+PROJECTED_FUNCS = {
+    "a10": a10_projected,
+    "gnfw": gnfw_projected,
+}
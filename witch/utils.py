@@ -3,6 +3,7 @@ A set of utility functions and constants used for unit conversions
 and adding generic structure common to multiple models.
 """
 
+import os
 from functools import partial
 
 import jax
@@ -11,6 +12,7 @@ import numpy as np
 from astropy import constants as const
 from astropy import units as u
 from astropy.cosmology import Planck15 as cosmo
+from jax.custom_derivatives import SymbolicZero
 
 jax.config.update("jax_enable_x64", True)
 # jax.config.update("jax_platform_name", "gpu")
@@ -151,7 +153,7 @@ def get_da(z):
 
         da: Conversion factor from arcseconds to MPc
     """
-    return jnp.interp(z, dzline, daline)
+    return jnp.interp(z, dzline, daline).astype(jnp.result_type(z))
 
 
 def get_nz(z):
@@ -166,7 +168,7 @@ def get_nz(z):
 
         nz: n at the given z.
     """
-    return jnp.interp(z, dzline, nzline)
+    return jnp.interp(z, dzline, nzline).astype(jnp.result_type(z))
 
 
 def get_hz(z):
@@ -181,31 +183,139 @@ def get_hz(z):
 
         hz: h at the given z.
     """
-    return jnp.interp(z, dzline, hzline)
+    return jnp.interp(z, dzline, hzline).astype(jnp.result_type(z))
 
 
 # FFT Operations
 # -----------------------------------------------------------
+def next_fast_len(n):
+    """
+    Get the smallest even 5-smooth number that is at least n.
+    FFTs of these sizes are fast, and keeping them even means that the
+    full size can be recovered from the output of rfft2.
+
+    Arguments:
+
+        n: The minimum length.
+
+    Returns:
+
+        fast_len: The FFT friendly length.
+    """
+    fast_len = 2 * (n // 2 + n % 2)
+    while True:
+        m = fast_len
+        for p in (2, 3, 5):
+            while m % p == 0:
+                m //= p
+        if m == 1:
+            return fast_len
+        fast_len += 2
+
+
+def conv_shape(image_shape, kernel_shape, linear=False):
+    """
+    Get the padded shape to perform an FFT convolution with.
+
+    Arguments:
+
+        image_shape: The shape of the image to be convolved.
+
+        kernel_shape: The shape of the convolution kernel.
+
+        linear: If True pad enough that the convolution is linear,
+                so signal near the edge of the image does not wrap around.
+                If False the convolution is circular, up to padding to an FFT friendly size.
+
+    Returns:
+
+        shape: The shape of the FFTs used for the convolution.
+    """
+    if linear:
+        return tuple(
+            next_fast_len(n + k - 1) for n, k in zip(image_shape, kernel_shape)
+        )
+    return tuple(next_fast_len(n) for n in image_shape)
+
+
+@partial(jax.jit, static_argnums=(1, 2))
+def kernel_fft(kernel, image_shape, linear=False):
+    """
+    Precompute the transform of a convolution kernel for use with fft_conv_ft.
+    This is useful when the same kernel, ie: the beam, is used many times.
+
+    Arguments:
+
+        kernel: The kernel to transform, should be 2d.
+                The center of the kernel is the pixel that would land at
+                image_shape // 2 if it were zero padded evenly on both sides to image_shape.
+
+        image_shape: The shape of the images that will be convolved.
+
+        linear: If True the convolution will be linear rather than circular.
+                See conv_shape for details.
+
+    Returns:
+
+        Fkernel: The real FFT of the kernel, centered on the origin of the padded grid.
+    """
+    shape = conv_shape(image_shape, kernel.shape, linear)
+    if kernel.shape[0] > shape[0] or kernel.shape[1] > shape[1]:
+        raise ValueError(
+            f"Kernel with shape {kernel.shape} is too big for an image with shape {image_shape}"
+        )
+    center = tuple(n // 2 - (n - k) // 2 for n, k in zip(image_shape, kernel.shape))
+    padded = jnp.zeros(shape, dtype=kernel.dtype)
+    padded = padded.at[: kernel.shape[0], : kernel.shape[1]].set(kernel)
+    padded = jnp.roll(padded, (-1 * center[0], -1 * center[1]), (0, 1))
+
+    return jnp.fft.rfft2(padded)
+
+
 @jax.jit
-def fft_conv(image, kernel):
+def fft_conv_ft(image, Fkernel):
     """
-    Perform a convolution using FFTs for speed.
+    Perform a convolution using real FFTs with a precomputed kernel transform.
 
     Arguments:
 
         image: Data to be convolved
 
-        kernel: Convolution kernel
+        Fkernel: Transform of the convolution kernel from kernel_fft.
 
     Returns:
 
         convolved_map: Image convolved with kernel.
     """
-    Fmap = jnp.fft.fft2(jnp.fft.fftshift(image))
-    Fkernel = jnp.fft.fft2(jnp.fft.fftshift(kernel))
-    convolved_map = jnp.fft.fftshift(jnp.real(jnp.fft.ifft2(Fmap * Fkernel)))
+    # The padded size is always even so we can recover it
+    shape = (Fkernel.shape[0], 2 * (Fkernel.shape[1] - 1))
+    Fmap = jnp.fft.rfft2(image, s=shape)
+    convolved_map = jnp.fft.irfft2(Fmap * Fkernel, s=shape)
+
+    return convolved_map[: image.shape[0], : image.shape[1]]
+
+
+@partial(jax.jit, static_argnums=(2,))
+def fft_conv(image, kernel, linear=False):
+    """
+    Perform a convolution using real FFTs for speed.
+    Both the image and the kernel are zero padded to an FFT friendly size.
+
+    Arguments:
 
-    return convolved_map
+        image: Data to be convolved
+
+        kernel: Convolution kernel, see kernel_fft for how it is centered.
+                Can be smaller than the image.
+
+        linear: If True pad enough that the convolution is linear.
+                Otherwise it is circular, see conv_shape for details.
+
+    Returns:
+
+        convolved_map: Image convolved with kernel.
+    """
+    return fft_conv_ft(image, kernel_fft(kernel, image.shape, linear))
 
 
 @partial(jax.jit, static_argnums=(1,))
@@ -236,7 +346,61 @@ def tod_hi_pass(tod, N_filt):
 
 # Model building tools
 # -----------------------------------------------------------
-def make_grid(r_map, dx, dy=None, dz=None, x0=0, y0=0):
+def make_los(r_map, dz, method="uniform", n_z=None, stretch=0.0):
+    """
+    Make the samples and quadrature weights to integrate along the line of sight with.
+    The samples are placed at z = r_map * sinh(stretch * t) / sinh(stretch)
+    for t in [-1, 1], so a positive stretch concentrates them near z = 0
+    where the cluster core needs the most resolution.
+
+    Arguments:
+
+        r_map: Size of grid along the line of sight.
+
+        dz: Grid resolution along the line of sight, only used to set the default n_z.
+
+        method: How to place samples in t.
+                'uniform' uses evenly spaced samples and trapezoidal weights.
+                'gauss' uses Gauss-Legendre nodes and weights.
+
+        n_z: The number of samples to use.
+             If None then this is 2*int(r_map / dz).
+             Odd values are rounded up so that no sample sits at z = 0,
+             where profiles like the gNFW diverge.
+
+        stretch: How strongly to concentrate samples near z = 0.
+                 If 0 then samples are not stretched.
+
+    Returns:
+
+        z: The line of sight samples in the same units as r_map.
+
+        weights: The quadrature weight for each sample in the same units as r_map.
+    """
+    if n_z is None:
+        n_z = 2 * int(r_map / dz)
+    n_z += n_z % 2
+
+    if method == "uniform":
+        t = np.linspace(-1, 1, n_z)
+        w_t = np.full(n_z, t[1] - t[0])
+        w_t[[0, -1]] /= 2
+    elif method == "gauss":
+        t, w_t = np.polynomial.legendre.leggauss(n_z)
+    else:
+        raise ValueError(f"Invalid line of sight quadrature method: {method}")
+
+    if stretch > 0:
+        z = r_map * np.sinh(stretch * t) / np.sinh(stretch)
+        weights = w_t * r_map * stretch * np.cosh(stretch * t) / np.sinh(stretch)
+    else:
+        z = r_map * t
+        weights = w_t * r_map
+
+    return z, weights
+
+
+def make_grid(r_map, dx, dy=None, dz=None, x0=0, y0=0, z=None):
     """
     Make coordinate grids to build models in.
     All grids are sparse and are int(2*r_map / dr) in each dimension.
@@ -257,6 +421,9 @@ def make_grid(r_map, dx, dy=None, dz=None, x0=0, y0=0):
 
         y0: Origin of grid in Dec, assumed to be in same units as r_map.
 
+        z: Line of sight samples to use, see make_los.
+           If provided then dz is ignored.
+
     Returns:
 
         x: Grid of x coordinates in same units as r_map.
@@ -277,7 +444,10 @@ def make_grid(r_map, dx, dy=None, dz=None, x0=0, y0=0):
         + x0
     )
     y = jnp.linspace(-1 * r_map, r_map, 2 * int(r_map / dy)) + y0
-    z = jnp.linspace(-1 * r_map, r_map, 2 * int(r_map / dz))
+    if z is None:
+        z = jnp.linspace(-1 * r_map, r_map, 2 * int(r_map / dz))
+    else:
+        z = jnp.array(z)
 
     return tuple(jnp.meshgrid(x, y, z, sparse=True, indexing="ij") + [x0, y0])
 
@@ -379,12 +549,18 @@ def transform_grid(dx, dy, dz, r_1, r_2, r_3, theta, xyz):
     # Get origin
     x0, y0 = xyz[3], xyz[4]
     # Shift origin
-    x = (xyz[0] - (x0 + dx / jnp.cos(y0 / rad_to_arcsec))) * jnp.cos(
+    # Subtract the origin first, the x and y grids contain the absolute position
+    # so this needs to happen at their precision before anything else
+    x = ((xyz[0] - x0) - dx / jnp.cos(y0 / rad_to_arcsec)) * jnp.cos(
         (y0 + dy) / rad_to_arcsec
     )
-    y = xyz[1] - (y0 + dy)
+    y = (xyz[1] - y0) - dy
     z = xyz[2] - dz
 
+    # Everything else is done at the precision of the z grid
+    x = x.astype(xyz[2].dtype)
+    y = y.astype(xyz[2].dtype)
+
     # Rotate
     xx = x * jnp.cos(theta) + y * jnp.sin(theta)
     yy = y * jnp.cos(theta) - x * jnp.sin(theta)
@@ -397,6 +573,91 @@ def transform_grid(dx, dy, dz, r_1, r_2, r_3, theta, xyz):
     return x, y, z
 
 
+def box_size(coord, radius):
+    """
+    Get the number of samples needed for a block that contains a sphere of a given radius.
+    The block is assumed to be centered on the sample nearest the center of the sphere,
+    so this is safe to use for non-uniform coordinates.
+
+    Arguments:
+
+        coord: The 1D coordinates of the samples along an axis.
+               Should be in the same units as radius.
+
+        radius: The radius of the sphere.
+
+    Returns:
+
+        n_box: The number of samples in the block.
+               Never larger than the number of samples.
+    """
+    coord = np.sort(np.ravel(coord))
+    if len(coord) < 2:
+        return len(coord)
+    # The center can be up to half a sample away from the nearest sample
+    radius = radius + np.max(np.diff(coord)) / 2
+    # Most samples that can be within radius on one side of the center
+    n_side = np.max(
+        np.searchsorted(coord, coord + radius, side="right") - np.arange(len(coord))
+    )
+    return int(min(2 * n_side + 1, len(coord)))
+
+
+def gnfw_projected_table(gamma, alpha, beta, cache_dir=None, n_s=1024):
+    """
+    Tabulate the line of sight integral of a gNFW profile with fixed shape.
+    The table is in scaled units, so it is the integral of
+    1/(r**gamma * (1 + r**alpha) ** ((beta - gamma) / alpha))
+    along an infinite line of sight at a projected radius s.
+    Any amplitude and scale radius can then be applied analytically.
+
+    Arguments:
+
+        gamma: The central slope
+
+        alpha: The intermediate slope
+
+        beta: The outer slope, must be larger than 1 for the integral to converge.
+
+        cache_dir: Directory to cache the table in.
+                   If None the table is not cached.
+
+        n_s: Number of projected radii to tabulate.
+
+    Returns:
+
+        log_s: Log of the projected radii, has shape (n_s,).
+
+        log_table: Log of the integrated profile at each projected radius.
+    """
+    if beta <= 1:
+        raise ValueError("gNFW line of sight integral only converges for beta > 1")
+
+    path = None
+    if cache_dir is not None:
+        path = os.path.join(
+            cache_dir, f"gnfw_projected_{gamma:.10g}_{alpha:.10g}_{beta:.10g}_{n_s}.npz"
+        )
+        if os.path.isfile(path):
+            table = np.load(path)
+            return table["log_s"], table["log_table"]
+
+    # Log spaced samples resolve both the core and the tail
+    s = np.logspace(-5, 4, n_s)
+    l = np.concatenate(([0], np.logspace(-7, 5, 6000)))
+    r = np.sqrt(s[:, None] ** 2 + l[None, :] ** 2)
+    profile = 1 / ((r**gamma) * (1 + r**alpha) ** ((beta - gamma) / alpha))
+    table = 2 * np.sum(0.5 * (profile[:, 1:] + profile[:, :-1]) * np.diff(l), axis=-1)
+
+    log_s = np.log(s)
+    log_table = np.log(table)
+    if path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        np.savez(path, log_s=log_s, log_table=log_table)
+
+    return log_s, log_table
+
+
 def tod_to_index(xi, yi, x0, y0, grid, conv_factor):
     """
     Convert RA/Dec TODs to index space.
@@ -442,13 +703,303 @@ def tod_to_index(xi, yi, x0, y0, grid, conv_factor):
     return idx, idy
 
 
+def _bilinear_stencil(x, y, xp, yp):
+    """
+    Compute the indices and weights for bilinear interpolation.
+    The weights of out of bounds samples are set to 0.
+
+    Arguments:
+
+        x: X values to return interpolated values at.
+
+        y: Y values to return interpolated values at.
+
+        xp: X values to interpolate with, should be 1D.
+            Assumed to be sorted.
+
+        yp: Y values to interpolate with, should be 1D.
+            Assumed to be sorted.
+
+    Returns:
+
+        ix: Index of the upper bounding point in xp.
+
+        iy: Index of the upper bounding point in yp.
+
+        weights: The weights of the points at
+                 (ix - 1, iy - 1), (ix, iy - 1), (ix - 1, iy), and (ix, iy).
+    """
+    # Figure out bounds and mapping
+    # This breaks if xp, yp is not sorted
+    ix = jnp.clip(jnp.searchsorted(xp, x, side="right"), 1, len(xp) - 1)
+    iy = jnp.clip(jnp.searchsorted(yp, y, side="right"), 1, len(yp) - 1)
+
+    denom_x = xp[ix] - xp[ix - 1]
+    dx_1 = (x - xp[ix - 1]) / denom_x
+    dx_2 = (xp[ix] - x) / denom_x
+    denom_y = yp[iy] - yp[iy - 1]
+    dy_1 = (y - yp[iy - 1]) / denom_y
+    dy_2 = (yp[iy] - y) / denom_y
+
+    # Zero out the out of bounds values
+    outside = (x < xp[0]) + (x > xp[-1]) + (y < yp[0]) + (y > yp[-1])
+    dy_1 = jnp.where(outside, 0.0, dy_1)
+    dy_2 = jnp.where(outside, 0.0, dy_2)
+
+    return ix, iy, (dx_2 * dy_2, dx_1 * dy_2, dx_2 * dy_1, dx_1 * dy_1)
+
+
+@jax.jit
+def bilinear_stencil(x, y, xp, yp):
+    """
+    Precompute the stencil for bilinear interpolation.
+    This lets repeated interpolations at the same points be done
+    with stencil_interp, which is just a gather and a weighted sum.
+    Out of bounds points get weights of 0.
+
+    Arguments:
+
+        x: X values to return interpolated values at.
+
+        y: Y values to return interpolated values at.
+
+        xp: X values to interpolate with, should be 1D.
+            Assumed to be sorted.
+
+        yp: Y values to interpolate with, should be 1D.
+            Assumed to be sorted.
+
+    Returns:
+
+        idx: Indices of the four bounding points in the flattened (len(xp), len(yp)) grid.
+             Has shape (4,) + x.shape and dtype int32.
+
+        weights: The weights of the four bounding points.
+                 Has shape (4,) + x.shape.
+    """
+    if len(xp.shape) != 1:
+        raise ValueError("xp must be 1D")
+    if len(yp.shape) != 1:
+        raise ValueError("yp must be 1D")
+
+    ix, iy, weights = _bilinear_stencil(x, y, xp, yp)
+    n_y = len(yp)
+    idx = jnp.array(
+        [
+            (ix - 1) * n_y + iy - 1,
+            ix * n_y + iy - 1,
+            (ix - 1) * n_y + iy,
+            ix * n_y + iy,
+        ],
+        dtype=jnp.int32,
+    )
+
+    return idx, jnp.array(weights)
+
+
+def _uniform_axis(x, xp, order):
+    """
+    Indices and 1D interpolation weights along one axis of a uniform grid.
+
+    Arguments:
+
+        x: Values to return interpolated values at.
+
+        xp: Uniformly spaced values to interpolate with, should be 1D.
+            Assumed to be sorted.
+
+        order: The interpolation order, 1 for linear and 3 for cubic.
+
+    Returns:
+
+        idx: List of the indices of the bounding points in xp.
+
+        weights: List of the weights of the bounding points.
+
+        outside: True where x is out of bounds.
+    """
+    n_x = len(xp)
+    fx = (x - xp[0]) * (n_x - 1) / (xp[-1] - xp[0])
+    ix = jnp.clip(jnp.floor(fx).astype(jnp.int32), 0, n_x - 2)
+    t = fx - ix
+    outside = (x < xp[0]) + (x > xp[-1])
+    if order == 1:
+        return [ix, ix + 1], [1 - t, t], outside
+    if order == 3:
+        # Keys cubic convolution with a = -0.5, edges are replicated
+        idx = [jnp.clip(ix + i, 0, n_x - 1) for i in range(-1, 3)]
+        t2 = t * t
+        t3 = t2 * t
+        weights = [
+            0.5 * (-t3 + 2 * t2 - t),
+            0.5 * (3 * t3 - 5 * t2 + 2),
+            0.5 * (-3 * t3 + 4 * t2 + t),
+            0.5 * (t3 - t2),
+        ]
+        return idx, weights, outside
+    raise ValueError(f"Invalid interpolation order {order}, must be 1 or 3")
+
+
+@partial(jax.jit, static_argnums=(4,))
+def uniform_stencil(x, y, xp, yp, order=1):
+    """
+    Precompute the stencil for interpolation on a uniform grid,
+    such as the ones from make_grid.
+    Since the grid is uniform the indices are computed directly
+    rather than with a search.
+    Out of bounds points get weights of 0.
+
+    Arguments:
+
+        x: X values to return interpolated values at.
+
+        y: Y values to return interpolated values at.
+
+        xp: X values to interpolate with, should be 1D and uniformly spaced.
+            Assumed to be sorted.
+
+        yp: Y values to interpolate with, should be 1D and uniformly spaced.
+            Assumed to be sorted.
+
+        order: The interpolation order.
+               1 for bilinear and 3 for bicubic.
+
+    Returns:
+
+        idx: Indices of the bounding points in the flattened (len(xp), len(yp)) grid.
+             Has shape ((order + 1)**2,) + x.shape and dtype int32.
+
+        weights: The weights of the bounding points.
+                 Has shape ((order + 1)**2,) + x.shape.
+    """
+    if len(xp.shape) != 1:
+        raise ValueError("xp must be 1D")
+    if len(yp.shape) != 1:
+        raise ValueError("yp must be 1D")
+
+    idx_x, weights_x, outside_x = _uniform_axis(x, xp, order)
+    idx_y, weights_y, outside_y = _uniform_axis(y, yp, order)
+    n_y = len(yp)
+    idx = jnp.array(
+        [ix * n_y + iy for ix in idx_x for iy in idx_y],
+        dtype=jnp.int32,
+    )
+    weights = jnp.array([wx * wy for wx in weights_x for wy in weights_y])
+    weights = jnp.where(outside_x + outside_y, 0.0, weights)
+
+    return idx, weights
+
+
+def _gather(fps, idx, weights):
+    return jnp.sum(weights * fps[:, idx], axis=1)
+
+
+def _sorted_gather(fps, idx, weights, perm):
+    # Same as _gather but the reads are done in sorted order,
+    # so the transpose is a scatter add over sorted indices
+    n = len(fps)
+    vals = fps.at[:, idx.ravel()[perm]].get(indices_are_sorted=True)
+    vals = vals * weights.ravel()[perm]
+    vals = jnp.zeros_like(vals).at[:, perm].add(vals, unique_indices=True)
+
+    return jnp.sum(vals.reshape((n,) + idx.shape), axis=1)
+
+
+@jax.custom_jvp
+def _stencil_interp(fps, idx, weights, perm):
+    return _gather(fps, idx, weights)
+
+
+@partial(_stencil_interp.defjvp, symbolic_zeros=True)
+def _stencil_interp_jvp(primals, tangents):
+    # The tangent is linear in fps_dot, its transpose is a segment sum over the stencil
+    fps, idx, weights, perm = primals
+    fps_dot, _, weights_dot, _ = tangents
+    out = _gather(fps, idx, weights)
+    out_dot = jnp.zeros_like(out)
+    if not isinstance(fps_dot, SymbolicZero):
+        if perm is None:
+            out_dot = out_dot + _gather(fps_dot, idx, weights)
+        else:
+            out_dot = out_dot + _sorted_gather(fps_dot, idx, weights, perm)
+    if not isinstance(weights_dot, SymbolicZero):
+        out_dot = out_dot + _gather(fps, idx, weights_dot)
+
+    return out, out_dot
+
+
+@jax.jit
+def stencil_interp(fps, idx, weights, perm=None):
+    """
+    Interpolate a stack of flattened functions with a precomputed stencil.
+    The transpose with respect to fps is a segment sum over the stencil indices,
+    if perm is provided then the indices are sorted first so the sum is contiguous.
+    Forward and reverse mode both work, including with respect to the weights.
+
+    Arguments:
+
+        fps: Flattened function values, should have shape (n, npix).
+
+        idx: Indices of the bounding points, see uniform_stencil or bilinear_stencil.
+
+        weights: Weights of the bounding points, see uniform_stencil or bilinear_stencil.
+
+        perm: Permutation that sorts idx.ravel().
+              If None the transpose uses an unsorted segment sum.
+
+    Returns:
+
+        f: The interpolated values, has shape (n,) + idx.shape[1:].
+    """
+    return _stencil_interp(fps, idx, weights, perm)
+
+
+@jax.jit
+def bilinear_interp_stack(x, y, xp, yp, fps):
+    """
+    Bilinear interpolation of a stack of functions sampled on the same grid.
+    The interpolation indices and weights are only computed once
+    and all the functions are gathered together.
+    Out of bounds values are set to 0.
+
+    Arguments:
+
+        x: X values to return interpolated values at.
+
+        y: Y values to return interpolated values at.
+
+        xp: X values to interpolate with, should be 1D.
+            Assumed to be sorted.
+
+        yp: Y values to interpolate with, should be 1D.
+            Assumed to be sorted.
+
+        fps: Functon values at (xp, yp), should have shape (n, len(xp), len(yp)).
+             Note that if you are using meshgrid, we assume 'ij' indexing.
+
+    Return:
+
+        f: The interpolated values, has shape (n,) + x.shape.
+    """
+    if fps.shape[1:] != xp.shape + yp.shape:
+        raise ValueError(
+            "Incompatible shapes for fps, xp, yp: %s, %s, %s",
+            fps.shape,
+            xp.shape,
+            yp.shape,
+        )
+
+    idx, weights = bilinear_stencil(x, y, xp, yp)
+
+    return _gather(fps.reshape((len(fps), -1)), idx, weights)
+
+
 @jax.jit
 def bilinear_interp(x, y, xp, yp, fp):
     """
     JAX implementation of bilinear interpolation.
     Out of bounds values are set to 0.
-    Using the repeated linear interpolation method here,
-    see https://en.wikipedia.org/wiki/Bilinear_interpolation#Repeated_linear_interpolation.
+    See https://en.wikipedia.org/wiki/Bilinear_interpolation#Weighted_mean.
 
     Arguments:
 
@@ -469,10 +1020,6 @@ def bilinear_interp(x, y, xp, yp, fp):
 
         f: The interpolated values
     """
-    if len(xp.shape) != 1:
-        raise ValueError("xp must be 1D")
-    if len(yp.shape) != 1:
-        raise ValueError("yp must be 1D")
     if fp.shape != xp.shape + yp.shape:
         raise ValueError(
             "Incompatible shapes for fp, xp, yp: %s, %s, %s",
@@ -481,32 +1028,7 @@ def bilinear_interp(x, y, xp, yp, fp):
             yp.shape,
         )
 
-    # Figure out bounds and mapping
-    # This breaks if xp, yp is not sorted
-    ix = jnp.clip(jnp.searchsorted(xp, x, side="right"), 1, len(xp) - 1)
-    iy = jnp.clip(jnp.searchsorted(yp, y, side="right"), 1, len(yp) - 1)
-    q_11 = fp[ix - 1, iy - 1]
-    q_21 = fp[ix, iy - 1]
-    q_12 = fp[ix - 1, iy]
-    q_22 = fp[ix, iy]
-
-    # Interpolate in x to start
-    denom_x = xp[ix] - xp[ix - 1]
-    dx_1 = x - xp[ix - 1]
-    dx_2 = xp[ix] - x
-    f_xy1 = (dx_2 * q_11 + dx_1 * q_21) / denom_x
-    f_xy2 = (dx_2 * q_12 + dx_1 * q_22) / denom_x
-
-    # Now do y as well
-    denom_y = yp[iy] - yp[iy - 1]
-    dy_1 = y - yp[iy - 1]
-    dy_2 = yp[iy] - y
-    f = (dy_2 * f_xy1 + dy_1 * f_xy2) / denom_y
-
-    # Zero out the out of bounds values
-    f = jnp.where((x < xp[0]) + (x > xp[-1]) + (y < yp[0]) + (y > yp[-1]), 0.0, f)
-
-    return f
+    return bilinear_interp_stack(x, y, xp, yp, fp[None])[0]
 
 
 def beam_double_gauss(dr, fwhm1=9.735, amp1=0.9808, fwhm2=32.627, amp2=0.0192):